@@ -2,8 +2,7 @@
 ## Imports
 ###############################################################################
 from django.conf import settings
-from django.template.loader import render_to_string
-from notifier.backends import BaseBackend
+from notifier.backends import BaseBackend, render_to_string
 from twilio.rest import TwilioRestClient
 
 
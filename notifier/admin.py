@@ -40,3 +40,11 @@ class SentNotifcationAdmin(admin.ModelAdmin):
     list_display = ('user', 'notification', 'backend', 'success')
     readonly_fields = ('user', 'notification', 'backend', 'success')
 admin.site.register(models.SentNotification, SentNotifcationAdmin)
+
+
+class FailedDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('user', 'notification', 'backend', 'attempts',
+        'next_attempt', 'status')
+    list_filter = ('status', 'backend')
+    readonly_fields = ('user', 'notification', 'backend', 'context')
+admin.site.register(models.FailedDelivery, FailedDeliveryAdmin)
@@ -2,13 +2,131 @@
 ## Imports
 ###############################################################################
 # Python
-from smtplib import SMTPException
+from copy import copy
+import os
+from smtplib import SMTPException, SMTPServerDisconnected
+import socket
 
 # Django
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from django.core.mail import get_connection, send_mail
+from django.template import Context, loader
+
+# User
+from notifier import metrics
+
+
+###############################################################################
+## Settings
+###############################################################################
+# Number of emails sent over one connection to the email server when
+# sending a notification to many users. Defined here rather than in
+# notifier.settings, which imports the backend classes.
+EMAIL_CHUNK_SIZE = getattr(settings, 'NOTIFIER_EMAIL_CHUNK_SIZE', 100)
+
+
+###############################################################################
+## Templates
+###############################################################################
+# Compiled templates by template name (and modification time with DEBUG)
+TEMPLATE_CACHE = {}
+
+
+def _get_template_mtime(template_name):
+    """
+    Returns the modification time of the file the template is loaded from,
+    or None if it is not loaded from a file.
+    """
+    for template_loader in loader.template_source_loaders or ():
+        for source_loader in getattr(template_loader, 'loaders',
+                [template_loader]):
+            if not hasattr(source_loader, 'get_template_sources'):
+                continue
+            for path in source_loader.get_template_sources(template_name):
+                if os.path.exists(path):
+                    return os.path.getmtime(path)
+    return None
+
+
+def get_template(template_name):
+    """
+    Returns the compiled template, loading and compiling it only once per
+    process. With DEBUG the template is compiled again when its file is
+    modified.
+    """
+    key = template_name
+    if settings.DEBUG:
+        key = (template_name, _get_template_mtime(template_name))
+
+    try:
+        return TEMPLATE_CACHE[key]
+    except KeyError:
+        template = TEMPLATE_CACHE[key] = loader.get_template(template_name)
+        return template
+
+
+def render_to_string(template_name, context):
+    """
+    `django.template.loader.render_to_string` using compiled templates
+    from `get_template`. `context` is a dictionary or a `Context`.
+    """
+    if not isinstance(context, Context):
+        context = Context(context)
+    with metrics.timed('render'):
+        return get_template(template_name).render(context)
+
+
+###############################################################################
+## Context
+###############################################################################
+class SharedVariables(dict):
+    """
+    The variables added by `get_context`, left out by `get_context_data`.
+    """
+
+
+def get_context(context=None):
+    """
+    Returns a `Context` with the variables shared by all recipients of a send
+    and `context` on top of them. `context` is not copied.
+
+    Compute it once per send and pass a `copy` of it to `BaseBackend.send`
+    for every recipient, which only copies the stack of dictionaries.
+    """
+    shared = Context(SharedVariables({
+        'site': Site.objects.get_current(),
+        'STATIC_URL': settings.STATIC_URL,
+    }))
+    if context:
+        shared.update(context)
+    return shared
+
+
+def get_context_data(context):
+    """
+    Returns the variables of a context without the ones added by
+    `get_context`, as a dictionary. Dictionaries are returned as they are.
+    """
+    if not isinstance(context, Context):
+        return dict(context or {})
+    data = {}
+    # The first dictionary holds the builtins
+    for d in context.dicts[1:]:
+        if not isinstance(d, SharedVariables):
+            data.update(d)
+    return data
+
+
+def get_user_context(context, user, contexts=None):
+    """
+    Returns a copy of `context` for `user`, with the variables for the user
+    in `contexts`, a dictionary with user ids as key, on top.
+    """
+    context = copy(context)
+    if contexts and user.pk in contexts:
+        context.update(contexts[user.pk])
+    return context
 
 
 ###############################################################################
@@ -22,19 +140,36 @@ class BaseBackend(object):
 
     def __init__(self, notification, *args, **kwargs):
         self.notification = notification
-        self.template = ('/notifier/%s_%s.txt' % (notification.name, self.name))
+        # Digests of buffered notifications use their own templates
+        self.digest = kwargs.get('digest', False)
+        self.template_prefix = 'notifier/%s_%s%s' % (notification.name,
+            self.name, '_digest' if self.digest else '')
+        self.template = self.template_prefix + '.txt'
 
     # Define how to send the notification
     def send(self, user, context=None):
-        if not context:
-            self.context = {}
-        else:
+        if isinstance(context, Context):
             self.context = context
+        else:
+            self.context = get_context(context)
+
+        self.context.update({'user': user})
+
+    def send_many(self, users, context=None, contexts=None):
+        """
+        Send the notification to all `users`. Override to send in batches
+        when the delivery service supports it, the default calls `send` for
+        every user with its own copy of the context.
 
-        self.context.update({
-            'user': user,
-            'site': Site.objects.get_current()
-        })
+        `contexts` has variables for single users, by user id, e.g. the
+        items of digests. It is only passed for digests.
+
+        Returns a list of ``(user, success)`` tuples.
+        """
+        if not isinstance(context, Context):
+            context = get_context(context)
+        return [(user, self.send(user, get_user_context(context, user,
+            contexts))) for user in users]
 
 
 class EmailBackend(BaseBackend):
@@ -45,12 +180,11 @@ class EmailBackend(BaseBackend):
     def __init__(self, notification, *args, **kwargs):
         super(EmailBackend, self).__init__(notification, *args, **kwargs)
 
-        self.template_subject = (
-            'notifier/%s_%s_subject.txt' % (notification.name, self.name)
-        )
-        self.template_message = (
-            'notifier/%s_%s_message.txt' % (notification.name, self.name)
-        )
+        self.template_subject = self.template_prefix + '_subject.txt'
+        self.template_message = self.template_prefix + '_message.txt'
+
+        # Set by `send_many` to share one connection between messages
+        self.connection = None
 
     def send(self, user, context=None):
         super(EmailBackend, self).send(user, context)
@@ -60,9 +194,66 @@ class EmailBackend(BaseBackend):
         message = render_to_string(self.template_message, self.context)
 
         try:
-            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL,
-                [user.email])
-        except SMTPException:
+            self._send_mail(subject, message, [user.email])
+        except (SMTPException, socket.error):
             return False
         else:
             return True
+
+    def send_many(self, users, context=None, contexts=None):
+        """
+        Send the notification to all `users`, reusing one connection to the
+        email server for every NOTIFIER_EMAIL_CHUNK_SIZE messages. See
+        `BaseBackend.send_many` for `contexts`.
+
+        Returns a list of ``(user, success)`` tuples. All messages of a
+        chunk fail if the connection cannot be opened.
+        """
+        users = list(users)
+        if not isinstance(context, Context):
+            context = get_context(context)
+        chunk_size = EMAIL_CHUNK_SIZE
+        results = []
+
+        for start in range(0, len(users), chunk_size):
+            chunk = users[start:start + chunk_size]
+            self.connection = get_connection()
+            try:
+                self.connection.open()
+            except (SMTPException, socket.error):
+                self.connection = None
+                results.extend((user, False) for user in chunk)
+                continue
+            try:
+                for user in chunk:
+                    results.append((user, self.send(user,
+                        get_user_context(context, user, contexts))))
+            finally:
+                try:
+                    self.connection.close()
+                except SMTPException:
+                    pass
+                self.connection = None
+
+        return results
+
+    def _send_mail(self, subject, message, recipient_list):
+        if self.connection is None:
+            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL,
+                recipient_list)
+            return
+
+        try:
+            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL,
+                recipient_list, connection=self.connection)
+        except SMTPServerDisconnected:
+            # The server closed the shared connection, reconnect and retry
+            self.connection.close()
+            try:
+                self.connection.open()
+            except (SMTPException, socket.error):
+                # Leave the connection closed, the next message reconnects
+                self.connection.close()
+                raise
+            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL,
+                recipient_list, connection=self.connection)
@@ -0,0 +1,488 @@
+"""
+Benchmarks for the notifier pipeline.
+
+These are not run as part of the test suite. Run them from ``manage.py shell``
+against a database with the notifier tables, e.g.::
+
+    from notifier import benchmarks
+    benchmarks.bench_resolution_queries('notification-name')
+
+Every benchmark returns a dict of results. `run_suite` seeds its own data and
+is run by the ``notifier_benchmark`` management command.
+"""
+###############################################################################
+## Imports
+###############################################################################
+# Python
+from datetime import timedelta
+from multiprocessing import Process, Queue
+import resource
+from time import sleep, time
+
+# Django
+from django.contrib.auth.models import User, Group
+from django.db import connection, transaction
+from django.db.models import Count
+from django.template import Template, loader
+from django.test.utils import override_settings
+from django.utils.timezone import now
+
+# User
+from notifier import backends
+from notifier import dispatch
+from notifier import settings as notifier_settings
+from notifier import shortcuts
+from notifier.backends import BaseBackend, EmailBackend
+from notifier.forms import NotifierFormSet
+from notifier.models import (Backend, GroupPrefs, Notification,
+    SentNotification, SentNotificationWriter, UserPrefs,
+    rebuild_effective_prefs)
+
+
+###############################################################################
+## Helpers
+###############################################################################
+def count_queries(func, *args, **kwargs):
+    """
+    Call `func` and return a ``(queries, seconds)`` tuple.
+    """
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start_queries = len(connection.queries)
+    start = time()
+    try:
+        func(*args, **kwargs)
+    finally:
+        seconds = time() - start
+        queries = len(connection.queries) - start_queries
+        connection.use_debug_cursor = old_debug_cursor
+    return queries, seconds
+
+
+class LatencyBackend(BaseBackend):
+    """
+    Backend that takes `latency` seconds per message, like a provider API.
+    """
+    name = 'latency'
+    latency = 0.01
+
+    def send(self, user, context=None):
+        super(LatencyBackend, self).send(user, context)
+        sleep(self.latency)
+        return True
+
+
+class RenderBackend(BaseBackend):
+    """
+    Backend that renders a short message for every user without sending it.
+    """
+    name = 'render'
+    message = Template('{{ user.username }} on {{ site.domain }}')
+
+    def send(self, user, context=None):
+        super(RenderBackend, self).send(user, context)
+        self.message.render(self.context)
+        return True
+
+
+def _peak_memory():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(func, *args, **kwargs):
+    """
+    Call `func` inside a transaction that is rolled back and return its
+    queries, wall time and the growth of the peak resident set size of the
+    process, in kilobytes on Linux.
+    """
+    start = _peak_memory()
+    with transaction.commit_manually():
+        try:
+            queries, seconds = count_queries(func, *args, **kwargs)
+        finally:
+            transaction.rollback()
+    return {
+        'queries': queries,
+        'seconds': seconds,
+        'peak_memory_kb': _peak_memory() - start,
+    }
+
+
+###############################################################################
+## Benchmarks
+###############################################################################
+def bench_resolution_queries(name, sizes=(1, 10, 100, 1000)):
+    """
+    Compare the number of queries needed to resolve backends for `sizes`
+    users, one user at a time (`get_backends`) and in bulk
+    (`get_backends_bulk`).
+    """
+    notification = Notification.objects.get(name=name)
+    results = {}
+    for size in sizes:
+        users = list(User.objects.order_by('pk')[:size])
+
+        def per_user():
+            for user in users:
+                list(notification.get_backends(user))
+
+        results[len(users)] = {
+            'per_user': count_queries(per_user),
+            'bulk': count_queries(notification.get_backends_bulk, users),
+        }
+    return results
+
+
+def bench_sent_inserts(name, deliveries=10000, batch_size=500):
+    """
+    Compare writing `deliveries` SentNotification records one row at a time
+    with writing them through a `SentNotificationWriter`.
+
+    The records are written inside a transaction that is rolled back.
+    """
+    notification = Notification.objects.get(name=name)
+    backend = Backend.objects.all()[0]
+    users = list(User.objects.order_by('pk')[:deliveries])
+    records = [users[i % len(users)] for i in range(deliveries)]
+
+    def per_row():
+        for user in records:
+            SentNotification.objects.create(user=user,
+                notification=notification, backend=backend, success=True)
+
+    def batched():
+        with SentNotificationWriter(batch_size=batch_size) as writer:
+            for user in records:
+                writer.add(SentNotification(user=user,
+                    notification=notification, backend=backend, success=True))
+
+    results = {}
+    for key, func in (('per_row', per_row), ('batched', batched)):
+        with transaction.commit_manually():
+            try:
+                results[key] = count_queries(func)
+            finally:
+                transaction.rollback()
+    return results
+
+
+def bench_email_send(name, recipients=1000):
+    """
+    Compare sending `name` to `recipients` users one connection per message
+    (`EmailBackend.send`) with sending over shared connections
+    (`EmailBackend.send_many`), using the configured EMAIL_BACKEND.
+
+    Returns messages per second for both.
+    """
+    notification = Notification.objects.get(name=name)
+    users = list(User.objects.order_by('pk')[:recipients])
+
+    def per_message():
+        backend = EmailBackend(notification)
+        for user in users:
+            backend.send(user)
+
+    def shared_connection():
+        EmailBackend(notification).send_many(users)
+
+    results = {}
+    for key, func in (('per_message', per_message),
+            ('shared_connection', shared_connection)):
+        queries, seconds = count_queries(func)
+        results[key] = len(users) / seconds
+    return results
+
+
+def bench_render(name, recipients=10000):
+    """
+    Compare rendering the email templates of `name` for `recipients` users
+    with django's `render_to_string` and with the compiled templates of
+    `notifier.backends.render_to_string`.
+
+    Returns renders per second for both.
+    """
+    notification = Notification.objects.get(name=name)
+    backend = EmailBackend(notification)
+    users = list(User.objects.order_by('pk')[:recipients])
+    users = [users[i % len(users)] for i in range(recipients)]
+
+    results = {}
+    for key, render in (('django', loader.render_to_string),
+            ('compiled', backends.render_to_string)):
+        start = time()
+        for user in users:
+            context = {'user': user}
+            render(backend.template_subject, context)
+            render(backend.template_message, context)
+        results[key] = recipients / (time() - start)
+    return results
+
+
+def _send_in_process(results, key, notification, users):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend'):
+        with transaction.commit_manually():
+            try:
+                notification.send(users())
+            finally:
+                transaction.rollback()
+    end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((key, end - start))
+
+
+def bench_send_memory(name, recipients=100000):
+    """
+    Compare the peak memory used to send `name` to `recipients` users passed
+    as a list and as a queryset, which is read in chunks.
+
+    Every send runs in its own process with a dummy email backend, inside
+    a transaction that is rolled back. Returns the growth of the peak
+    resident set size of the process, in kilobytes on Linux.
+    """
+    notification = Notification.objects.get(name=name)
+    ids = User.objects.order_by('pk').values_list('pk', flat=True)
+    last_pk = list(ids[recipients - 1:recipients])[0]
+
+    def queryset():
+        return User.objects.filter(pk__lte=last_pk)
+
+    def materialised():
+        return list(queryset())
+
+    results = Queue()
+    connection.close()
+    for key, users in (('list', materialised), ('queryset', queryset)):
+        process = Process(target=_send_in_process,
+            args=(results, key, notification, users))
+        process.start()
+        process.join()
+    return dict(results.get() for i in range(2))
+
+
+def bench_dispatch(name, recipients=200, latency=0.01, threads=(1, 2, 4, 8)):
+    """
+    Measure the wall time to deliver `name` to `recipients` users with two
+    backends taking `latency` seconds per message, serially and with
+    `threads` threads per backend. Nothing is sent or recorded.
+    """
+    notification = Notification.objects.get(name=name)
+    users = list(User.objects.order_by('pk')[:recipients])
+    LatencyBackend.latency = latency
+    klass = 'notifier.benchmarks.LatencyBackend'
+    backend_users = {
+        Backend(pk=-1, name='latency-1', klass=klass): users,
+        Backend(pk=-2, name='latency-2', klass=klass): users,
+    }
+
+    results = {}
+    dispatcher = dispatch.SerialDispatcher()
+    start = time()
+    dispatcher.deliver(backend_users, notification, {})
+    results['serial'] = time() - start
+
+    for size in threads:
+        dispatcher = dispatch.ThreadedDispatcher(
+            {'latency-1': size, 'latency-2': size})
+        start = time()
+        try:
+            dispatcher.deliver(backend_users, notification, {})
+        finally:
+            dispatcher.close()
+        results[size] = time() - start
+    return results
+
+
+def _explain(sql, params):
+    if connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [' '.join(unicode(column) for column in row)
+        for row in cursor.fetchall()]
+
+
+def bench_unread_count(samples=100):
+    """
+    Measure `SentNotification.objects.unread_count` for the `samples` users
+    with the most SentNotification records, and the query plans of the
+    inbox and report queries, which should use the composite indexes.
+
+    Seed the table to the size of interest first, the plans depend on it.
+    """
+    user_ids = [row['user'] for row in SentNotification.objects.values(
+        'user').annotate(count=Count('pk')).order_by('-count')[:samples]]
+
+    start = time()
+    for user_id in user_ids:
+        SentNotification.objects.unread_count(user_id)
+    seconds = time() - start
+
+    inbox = SentNotification.objects.filter(user=user_ids[0], read=False)
+    report = SentNotification.objects.filter(
+        notification=SentNotification.objects.values_list(
+            'notification', flat=True)[0],
+        success=False,
+        created__gte=now() - timedelta(days=7)
+    ).values('notification').annotate(count=Count('pk'))
+
+    # The plan of the COUNT(*) is the plan of selecting the primary keys
+    plans = dict(
+        (key, _explain(*queryset.query.sql_with_params()))
+        for (key, queryset) in (
+            ('unread_count_plan', inbox.values('pk')),
+            ('inbox_plan', inbox.order_by('-created')[:20]),
+            ('report_plan', report),
+        )
+    )
+    plans.update({
+        'rows': SentNotification.objects.count(),
+        'unread_count_seconds': seconds / len(user_ids),
+    })
+    return plans
+
+
+###############################################################################
+## Suite
+###############################################################################
+# Prefix of the names of all objects created by `seed`
+SEED_PREFIX = 'notifier-bench'
+
+
+def seed(users=1000, groups=10, notifications=10):
+    """
+    Create `users` users spread over `groups` groups and `notifications`
+    public notifications with two `RenderBackend` backends. Every group
+    prefers the first backend and every second user the second one.
+
+    Returns the notifications.
+    """
+    unseed()
+    seeded_backends = []
+    for i in range(2):
+        backend, created = Backend.objects.get_or_create(
+            name='%s-%s' % (SEED_PREFIX, i),
+            defaults={'klass': 'notifier.benchmarks.RenderBackend'})
+        backend.enabled = True
+        backend.save()
+        seeded_backends.append(backend)
+    seeded_notifications = []
+    for i in range(notifications):
+        notification = Notification.objects.create(
+            name='%s-%s' % (SEED_PREFIX, i), display_name='Benchmark %s' % i)
+        notification.backends.add(*seeded_backends)
+        seeded_notifications.append(notification)
+
+    Group.objects.bulk_create([Group(name='%s-%s' % (SEED_PREFIX, i))
+        for i in range(groups)])
+    seeded_groups = list(Group.objects.filter(
+        name__startswith=SEED_PREFIX).order_by('pk'))
+    User.objects.bulk_create([User(username='%s-%s' % (SEED_PREFIX, i))
+        for i in range(users)])
+    seeded_users = list(User.objects.filter(
+        username__startswith=SEED_PREFIX).order_by('pk'))
+
+    User.groups.through.objects.bulk_create([
+        User.groups.through(user_id=user.pk,
+            group_id=seeded_groups[i % groups].pk)
+        for (i, user) in enumerate(seeded_users)
+    ])
+    GroupPrefs.objects.bulk_create([
+        GroupPrefs(group=group, notification=notification,
+            backend=seeded_backends[0])
+        for group in seeded_groups for notification in seeded_notifications
+    ])
+    UserPrefs.objects.bulk_create([
+        UserPrefs(user=user, notification=notification,
+            backend=seeded_backends[1])
+        for user in seeded_users[::2] for notification in seeded_notifications
+    ])
+
+    if notifier_settings.EFFECTIVE_PREFS:
+        rebuild_effective_prefs()
+    return seeded_notifications
+
+
+def unseed():
+    """
+    Delete the objects created by `seed`. The backends cannot be deleted,
+    they are disabled.
+    """
+    for model, field in ((User, 'username'), (Group, 'name'),
+            (Notification, 'name')):
+        model.objects.filter(**{field + '__startswith': SEED_PREFIX}).delete()
+    Backend.objects.filter(name__startswith=SEED_PREFIX).update(enabled=False)
+
+
+def _bench_cases(notifications, samples):
+    notification = notifications[0]
+    users = User.objects.filter(username__startswith=SEED_PREFIX)
+    sample_users = list(users.order_by('pk')[:samples])
+    backend_names = [backend.name for backend in
+        notification.backends.order_by('pk')]
+
+    def get_user_prefs():
+        for user in sample_users:
+            Notification.objects.get_user_prefs(user)
+
+    def render_formset():
+        for user in sample_users:
+            unicode(NotifierFormSet(user))
+
+    def update_preferences():
+        for user in sample_users:
+            shortcuts.update_preferences(notification.name, user,
+                {backend_names[0]: False, backend_names[1]: True})
+
+    def update_preferences_bulk():
+        shortcuts.update_preferences_bulk(
+            (user, notification, backend_names[0], False)
+            for user in sample_users for notification in notifications)
+
+    return (
+        ('send_notification', lambda: shortcuts.send_notification(
+            notification.name, users)),
+        ('get_user_prefs', get_user_prefs),
+        ('render_formset', render_formset),
+        ('update_preferences', update_preferences),
+        ('update_preferences_bulk', update_preferences_bulk),
+    )
+
+
+def _measure_in_process(results, key, func):
+    results.put((key, measure(func)))
+
+
+def run_suite(users=1000, groups=10, notifications=10, samples=100,
+        fork=True, keep=False):
+    """
+    Seed data with `seed` and measure `send_notification` to all users, and
+    `get_user_prefs`, `NotifierFormSet` rendering and preference updates for
+    `samples` users. Every case is measured with `measure`, in its own
+    process unless `fork` is False, and rolled back. The seeded data is
+    deleted afterwards unless `keep` is True.
+
+    Sends are rendered by `RenderBackend` and not delivered anywhere.
+    """
+    notifications = seed(users, groups, notifications)
+    try:
+        results = {}
+        for key, func in _bench_cases(notifications, samples):
+            if not fork:
+                results[key] = measure(func)
+                continue
+            queue = Queue()
+            connection.close()
+            process = Process(target=_measure_in_process,
+                args=(queue, key, func))
+            process.start()
+            process.join()
+            if process.exitcode:
+                raise RuntimeError('Benchmark %s failed' % key)
+            results.update([queue.get()])
+    finally:
+        if not keep:
+            unseed()
+    return results
@@ -0,0 +1,201 @@
+###############################################################################
+## Imports
+###############################################################################
+# Python
+from multiprocessing.pool import ThreadPool
+import os
+from threading import BoundedSemaphore, Lock
+
+# Django
+from django.db import connection
+from django.template import Context
+
+# User
+from notifier import backends as notifier_backends
+from notifier import settings as notifier_settings
+
+
+###############################################################################
+## Code
+###############################################################################
+# Thread pools shared by all sends in the process, by key
+POOLS = {}
+_pools_lock = Lock()
+_pools_pid = None
+
+
+def get_pool(key, threads):
+    """
+    Returns the process-wide pool of `threads` threads for `key`, created on
+    first use. Forked processes get new pools, their copies have no threads.
+    """
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            POOLS.clear()
+            _pools_pid = os.getpid()
+        try:
+            return POOLS[key]
+        except KeyError:
+            pool = POOLS[key] = ThreadPool(threads)
+            return pool
+
+
+def get_dispatcher():
+    """
+    Returns the dispatcher for the NOTIFIER_DISPATCH_THREADS setting.
+    """
+    if notifier_settings.DISPATCH_THREADS:
+        return ThreadedDispatcher(notifier_settings.DISPATCH_THREADS)
+    return SerialDispatcher()
+
+
+class SerialDispatcher(object):
+    """
+    Delivers one backend after another in the calling thread.
+    """
+    def deliver(self, backend_users, notification, context,
+            idempotency_key=None):
+        """
+        `backend_users` is a dictionary with `Backend` objects as key and
+        a list of users as value. `idempotency_key` is passed to
+        `Backend.deliver` for deliveries deferred to the queue.
+
+        Returns a list of ``(backend, results)`` tuples, where results is a
+        list of ``(user, success)`` tuples.
+        """
+        return [
+            (backend, backend.deliver(users, notification, context,
+                idempotency_key=idempotency_key))
+            for (backend, users) in backend_users.items()
+        ]
+
+    def close(self):
+        pass
+
+
+class ThreadedDispatcher(object):
+    """
+    Delivers every backend with its own pool of threads, sized by `threads`,
+    a dictionary with backend names as key. The users of a backend are split
+    between the threads of its pool.
+
+    The pools are shared by all sends in the process, so concurrent sends
+    together never use more threads per backend than configured.
+
+    Results are collected in the calling thread, which records them.
+    """
+    def __init__(self, threads):
+        self.threads = threads
+        self.pools = {}
+
+    def get_pool(self, backend):
+        try:
+            return self.pools[backend.name]
+        except KeyError:
+            threads = self.threads.get(backend.name, 1)
+            pool = self.pools[backend.name] = get_pool(
+                ('dispatch', backend.name, threads), threads)
+            return pool
+
+    def deliver(self, backend_users, notification, context,
+            idempotency_key=None):
+        # Look up the shared variables once, not in every thread
+        if not isinstance(context, Context):
+            context = notifier_backends.get_context(context)
+
+        pending = []
+        for backend, users in backend_users.items():
+            threads = self.threads.get(backend.name, 1)
+            per_thread = -(-len(users) // threads)
+            for start in range(0, len(users), per_thread):
+                pending.append((backend, self.get_pool(backend).apply_async(
+                    _deliver,
+                    (backend, users[start:start + per_thread], notification,
+                        context, idempotency_key)
+                )))
+
+        return [(backend, result.get()) for (backend, result) in pending]
+
+    def close(self):
+        # The pools are kept for the next sends
+        self.pools = {}
+
+
+def _deliver(backend, users, notification, context, idempotency_key=None):
+    try:
+        return backend.deliver(users, notification, context,
+            idempotency_key=idempotency_key)
+    finally:
+        # Every thread has its own database connection
+        connection.close()
+
+
+class ConcurrentDispatcher(object):
+    """
+    Delivers to every user separately with up to `concurrency` deliveries
+    in progress. The deliveries run in a pool of NOTIFIER_ASYNC_CONCURRENCY
+    threads shared by all sends in the process, so concurrent sends
+    together never use more threads than that.
+
+    Meant for backends that send one message per request, like HTTP APIs.
+    """
+    def __init__(self, concurrency=None):
+        if concurrency is None:
+            concurrency = notifier_settings.ASYNC_CONCURRENCY
+        self.concurrency = concurrency
+        self.pool = get_pool('async', notifier_settings.ASYNC_CONCURRENCY)
+
+    def deliver(self, backend_users, notification, context,
+            idempotency_key=None):
+        if not isinstance(context, Context):
+            context = notifier_backends.get_context(context)
+
+        # Taken here and released by the delivery, so waiting for a slot
+        # does not hold a thread of the shared pool
+        slots = BoundedSemaphore(self.concurrency)
+        pending = []
+        for backend, users in backend_users.items():
+            for user in users:
+                slots.acquire()
+                pending.append((backend, self.pool.apply_async(
+                    _deliver_with_slot,
+                    (slots, backend, [user], notification, context,
+                        idempotency_key))))
+        return [(backend, result.get()) for (backend, result) in pending]
+
+    def close(self):
+        pass
+
+
+def _deliver_with_slot(slots, backend, users, notification, context,
+        idempotency_key):
+    try:
+        return _deliver(backend, users, notification, context,
+            idempotency_key)
+    finally:
+        slots.release()
+
+
+def send_async(notification, users, context=None, concurrency=None):
+    """
+    Send `notification` in a background thread, delivering with a
+    `ConcurrentDispatcher`. The background threads are a pool of
+    NOTIFIER_ASYNC_SENDS threads, further sends wait for one of them.
+
+    Returns a `multiprocessing.pool.AsyncResult`. Its `get` method waits
+    for the send to complete and raises any exception from the send.
+    """
+    # Look up the shared variables in the calling thread
+    context = notifier_backends.get_context(context)
+
+    return get_pool('async-send', notifier_settings.ASYNC_SENDS).apply_async(
+        _send, (notification, users, context, concurrency))
+
+
+def _send(notification, users, context, concurrency):
+    try:
+        notification.send(users, context,
+            dispatcher=ConcurrentDispatcher(concurrency))
+    finally:
+        connection.close()
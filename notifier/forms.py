@@ -7,25 +7,31 @@ from django.forms.formsets import BaseFormSet
 
 # User
 from notifier.models import Notification
+from notifier.shortcuts import update_preferences_bulk
 
 
 ###############################################################################
 ## Forms
 ###############################################################################
 class NotifierForm(forms.Form):
-    def __init__(self, user=None, notification=None, *args, **kwargs):
+    def __init__(self, user=None, notification=None, prefs_dict=None,
+            *args, **kwargs):
         if not user:
             # Use try/except?
             user = kwargs['initial'].pop('user')
         if not notification:
             # Use try/except?
             notification = kwargs['initial'].pop('notification')
+        if prefs_dict is None and 'initial' in kwargs:
+            prefs_dict = kwargs['initial'].pop('prefs_dict', None)
 
         super(NotifierForm, self).__init__(*args, **kwargs)
 
         self.user = user
         self.notification = notification
-        self.prefs_dict = notification.get_user_prefs(user)
+        if prefs_dict is None:
+            prefs_dict = notification.get_user_prefs(user)
+        self.prefs_dict = prefs_dict
         self.backends_included = set()
         self.title = notification.display_name
 
@@ -36,10 +42,14 @@ class NotifierForm(forms.Form):
             )
             self.fields[backend.name].initial = value
 
-    def save(self, *args, **kwargs):
+    def update_prefs_dict(self):
         for backend, value in self.prefs_dict.items():
             self.prefs_dict[backend] = self.cleaned_data[backend.name]
-        return self.notification.update_user_prefs(self.user, self.prefs_dict)
+        return self.prefs_dict
+
+    def save(self, *args, **kwargs):
+        return self.notification.update_user_prefs(self.user,
+            self.update_prefs_dict())
 
 
 ###############################################################################
@@ -48,11 +58,15 @@ class NotifierForm(forms.Form):
 class NotifierFormSet(BaseFormSet):
     def __init__(self, user, data=None, files=None, **kwargs):
         notifications = Notification.objects.get_user_notifications(user)
+        prefs = Notification.objects.get_user_prefs(user, notifications)
         kwargs['initial'] = []
 
         for notification in notifications:
-            kwargs['initial'].append(
-                {'notification': notification, 'user': user})
+            kwargs['initial'].append({
+                'notification': notification,
+                'user': user,
+                'prefs_dict': prefs[notification]
+            })
 
         self.form = NotifierForm
         self.extra = 0
@@ -70,5 +84,11 @@ class NotifierFormSet(BaseFormSet):
         self.dm = self.backends_included  # aliased for backwards compatibility
 
     def save(self, *args, **kwargs):
-        for form in self.forms:
-            form.save()
+        """
+        Save the preferences of all forms with `update_preferences_bulk`,
+        in a number of queries that does not depend on the number of forms.
+        """
+        return update_preferences_bulk(
+            (form.user, form.notification, backend, value)
+            for form in self.forms
+            for (backend, value) in form.update_prefs_dict().items())
@@ -0,0 +1,63 @@
+###############################################################################
+## Imports
+###############################################################################
+# Python
+import json
+from optparse import make_option
+
+# Django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils.timezone import now
+
+# User
+from notifier import get_version
+from notifier.benchmarks import run_suite
+
+
+###############################################################################
+## Code
+###############################################################################
+class Command(BaseCommand):
+    help = ('Seed synthetic users, groups, preferences and notifications, '
+        'measure queries, wall time and peak memory of sending and '
+        'preference handling, and write the results as JSON.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=1000,
+            help='Number of users to seed.'),
+        make_option('--groups', type='int', default=10,
+            help='Number of groups to seed.'),
+        make_option('--notifications', type='int', default=10,
+            help='Number of notifications to seed.'),
+        make_option('--samples', type='int', default=100,
+            help='Number of users to read and update preferences for.'),
+        make_option('--output', metavar='FILE', default=None,
+            help='Write the JSON to FILE instead of standard output.'),
+        make_option('--keep', action='store_true', default=False,
+            help='Keep the seeded data.'),
+        make_option('--no-fork', action='store_false', dest='fork',
+            default=True,
+            help='Measure all cases in this process, the peak memory of '
+                'later cases then only shows growth over earlier ones.'),
+    )
+
+    def handle(self, *args, **options):
+        scale = dict((key, options[key])
+            for key in ('users', 'groups', 'notifications', 'samples'))
+        results = run_suite(fork=options['fork'], keep=options['keep'],
+            **scale)
+
+        content = json.dumps({
+            'version': get_version(),
+            'database': connection.vendor,
+            'date': now().isoformat(),
+            'scale': scale,
+            'results': results,
+        }, indent=2, sort_keys=True, separators=(',', ': '))
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(content + '\n')
+        else:
+            self.stdout.write(content + '\n')
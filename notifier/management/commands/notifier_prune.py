@@ -0,0 +1,123 @@
+###############################################################################
+## Imports
+###############################################################################
+# Python
+from datetime import timedelta
+import gzip
+import json
+from optparse import make_option
+import os
+from time import sleep
+
+# Django
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.timezone import now
+
+# User
+from notifier.models import SentNotification
+from notifier import settings as notifier_settings
+
+
+###############################################################################
+## Code
+###############################################################################
+EXPORT_FIELDS = ('id', 'user_id', 'notification_id', 'backend_id', 'success',
+    'read', 'created', 'updated')
+
+
+def prune_sent_notifications(before, batch_size=1000, export=None,
+        pause=0, progress=None):
+    """
+    Delete `SentNotification` records created before `before`,
+    `batch_size` records per transaction.
+
+    If `export` is given, every batch is written to it as JSON lines before
+    it is deleted. `progress` is called with the number of records deleted
+    so far after every batch.
+
+    Returns the number of records deleted.
+    """
+    queryset = SentNotification.objects.filter(created__lt=before).order_by(
+        'pk')
+    deleted = 0
+    last_pk = 0
+
+    while True:
+        with transaction.commit_on_success():
+            pks = list(queryset.filter(pk__gt=last_pk).values_list(
+                'pk', flat=True)[:batch_size])
+            if not pks:
+                break
+
+            if export is not None:
+                for row in SentNotification.objects.filter(
+                        pk__in=pks).order_by('pk').values(*EXPORT_FIELDS):
+                    export.write(json.dumps(row, cls=DjangoJSONEncoder))
+                    export.write('\n')
+                export.flush()
+
+            # Deleted unread notifications change the unread counters
+            user_ids = set(SentNotification.objects.filter(pk__in=pks,
+                read=False).values_list('user_id', flat=True))
+            SentNotification.objects.filter(pk__in=pks).delete()
+            SentNotification.objects.invalidate_unread_counts(user_ids)
+
+        deleted += len(pks)
+        last_pk = pks[-1]
+        if progress:
+            progress(deleted)
+        if pause:
+            sleep(pause)
+
+    return deleted
+
+
+class Command(BaseCommand):
+    help = ('Delete SentNotification records older than the retention '
+        'period, optionally exporting them to a compressed JSON lines file.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int',
+            default=notifier_settings.RETENTION_DAYS,
+            help='Keep records created in the last DAYS days.'),
+        make_option('--batch-size', type='int', default=1000,
+            help='Number of records deleted per transaction.'),
+        make_option('--export', metavar='DIRECTORY', default=None,
+            help='Write the records to a gzipped JSON lines file in '
+                'DIRECTORY before deleting them.'),
+        make_option('--pause', type='float', default=0,
+            help='Seconds to wait between batches.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['days'] is None:
+            raise CommandError('Set --days or NOTIFIER_RETENTION_DAYS.')
+        verbosity = int(options.get('verbosity', 1))
+        before = now() - timedelta(days=options['days'])
+
+        total = SentNotification.objects.filter(created__lt=before).count()
+        if verbosity:
+            self.stdout.write('%s records created before %s\n' % (
+                total, before.isoformat()))
+
+        def progress(deleted):
+            if verbosity:
+                self.stdout.write('Deleted %s of %s\n' % (deleted, total))
+
+        export = None
+        if options['export']:
+            path = os.path.join(options['export'],
+                'sentnotification-%s.jsonl.gz' % now().strftime(
+                    '%Y%m%d%H%M%S'))
+            export = gzip.open(path, 'wb')
+            if verbosity:
+                self.stdout.write('Exporting to %s\n' % path)
+
+        try:
+            prune_sent_notifications(before, options['batch_size'], export,
+                options['pause'], progress)
+        finally:
+            if export is not None:
+                export.close()
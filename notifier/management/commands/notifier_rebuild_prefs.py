@@ -0,0 +1,40 @@
+###############################################################################
+## Imports
+###############################################################################
+# Python
+from optparse import make_option
+
+# Django
+from django.core.management.base import BaseCommand, CommandError
+
+# User
+from notifier.models import check_effective_prefs, rebuild_effective_prefs
+
+
+###############################################################################
+## Code
+###############################################################################
+class Command(BaseCommand):
+    help = ('Rebuild the EffectivePrefs table from the User and Group '
+        'preferences, or compare it to them with --check.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=None,
+            help='Number of users handled at a time.'),
+        make_option('--check', action='store_true', default=False,
+            help='Only report differences, fail if there are any.'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            count = rebuild_effective_prefs(options['batch_size'])
+            self.stdout.write('Created %s effective preferences\n' % count)
+            return
+
+        differences = check_effective_prefs(options['batch_size'])
+        for notification_id, user_id, expected, stored in differences:
+            self.stdout.write(
+                'notification %s, user %s: expected backends %s, stored %s\n'
+                % (notification_id, user_id, sorted(expected), sorted(stored)))
+        if differences:
+            raise CommandError('%s differences found' % len(differences))
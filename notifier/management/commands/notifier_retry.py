@@ -0,0 +1,43 @@
+###############################################################################
+## Imports
+###############################################################################
+# Python
+from optparse import make_option
+
+# Django
+from django.core.management.base import BaseCommand
+
+# User
+from notifier.models import FailedDelivery, retry_failed_deliveries
+
+
+###############################################################################
+## Code
+###############################################################################
+class Command(BaseCommand):
+    help = 'Retry failed deliveries that are due.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+            help='Number of failed deliveries retried at a time.'),
+        make_option('--requeue-dead', action='store_true', default=False,
+            help='Retry the deliveries that ran out of attempts again.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options['requeue_dead']:
+            count = FailedDelivery.objects.requeue_dead()
+            if verbosity:
+                self.stdout.write('Requeued %s dead deliveries\n' % count)
+
+        totals = [0, 0, 0]
+        while True:
+            counts = retry_failed_deliveries(options['batch_size'])
+            if not any(counts):
+                break
+            totals = [total + count for (total, count) in zip(totals, counts)]
+
+        if verbosity:
+            self.stdout.write('Succeeded %s, failed %s, dead %s\n'
+                % tuple(totals))
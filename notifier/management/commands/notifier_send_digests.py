@@ -0,0 +1,21 @@
+###############################################################################
+## Imports
+###############################################################################
+# Django
+from django.core.management.base import BaseCommand
+
+# User
+from notifier.models import send_digests
+
+
+###############################################################################
+## Code
+###############################################################################
+class Command(BaseCommand):
+    help = ('Send the digests of buffered notifications whose digest window '
+        'has passed. See NOTIFIER_DIGESTS.')
+
+    def handle(self, *args, **options):
+        sent = send_digests()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('Sent %s digests\n' % sent)
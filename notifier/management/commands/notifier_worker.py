@@ -0,0 +1,83 @@
+###############################################################################
+## Imports
+###############################################################################
+# Python
+from multiprocessing import Process
+from optparse import make_option
+import os
+import socket
+from time import sleep
+
+# Django
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+# User
+from notifier.models import QueuedNotification
+from notifier import settings as notifier_settings
+
+
+###############################################################################
+## Code
+###############################################################################
+def run_worker(name, batch_size, interval, once, stdout=None):
+    """
+    Deliver queued sends until the queue is empty (`once`) or forever,
+    polling every `interval` seconds when there is nothing to do.
+    """
+    while True:
+        claimed = QueuedNotification.objects.claim(name, limit=batch_size,
+            timeout=notifier_settings.QUEUE_LOCK_TIMEOUT)
+
+        for queued in claimed:
+            try:
+                queued.deliver()
+            except Exception as e:
+                if stdout:
+                    stdout.write('%s: failed %s: %r\n' % (name, queued.pk, e))
+            else:
+                if stdout:
+                    stdout.write('%s: sent %s\n' % (name, queued.pk))
+
+        if not claimed:
+            if once:
+                return
+            sleep(interval)
+
+
+class Command(BaseCommand):
+    help = 'Deliver notifications queued by send_notification.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int',
+            default=notifier_settings.WORKERS,
+            help='Number of worker processes.'),
+        make_option('--batch-size', type='int', default=10,
+            help='Number of queued sends claimed at a time by a worker.'),
+        make_option('--interval', type='float', default=5,
+            help='Seconds to wait before polling an empty queue again.'),
+        make_option('--once', action='store_true', default=False,
+            help='Exit when the queue is empty.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        stdout = self.stdout if verbosity > 1 else None
+        prefix = '%s:%s' % (socket.gethostname(), os.getpid())
+        worker_args = (options['batch_size'], options['interval'],
+            options['once'], stdout)
+
+        if options['workers'] <= 1:
+            run_worker(prefix, *worker_args)
+            return
+
+        # Each process has to open its own database connection.
+        connection.close()
+        processes = [
+            Process(target=run_worker, args=('%s:%s' % (prefix, i),) + worker_args)
+            for i in range(options['workers'])
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -2,29 +2,62 @@
 ## Imports
 ###############################################################################
 # Python
-from collections import Iterable
+from collections import defaultdict, Iterable
+from datetime import timedelta
+import json
+import random
+from uuid import uuid4
 
 # Django
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils.timezone import now
+
+# User
+from notifier import settings as notifier_settings
 
 
 ###############################################################################
 ## Managers
 ###############################################################################
 class NotificationManager(models.Manager):
+    def _get_permitted(self, user):
+        """
+        Public notifications the user has the permissions for, with backends
+        and permissions prefetched.
+        """
+        notifications = self.filter(public=True).prefetch_related(
+            'backends', 'permissions__content_type')
+        return [notification for notification in notifications
+            if notification.check_perms(user)]
+
     def get_user_notifications(self, user):
-        ret_list = []
-        for notification in self.filter(public=True):
-            if notification.backends.all() and notification.check_perms(user):
-                ret_list.append(notification)
-        return ret_list
+        return [notification for notification in self._get_permitted(user)
+            if notification.backends.all()]
+
+    def get_user_prefs(self, user, notifications=None):
+        """
+        Returns a dictionary with the preferences of the user for every
+        notification, like `Notification.get_user_prefs`.
+
+        `notifications` defaults to all public notifications the user has
+        the permissions for.
+        """
+        if notifications is None:
+            notifications = self._get_permitted(user)
+        bitmaps = self.model.get_prefs_bitmaps_many(
+            [notification.pk for notification in notifications], [user])
 
-    def get_user_prefs(self, user):
         return_dict = {}
-        for notification in self.filter(public=True):
-            if notification.check_perms(user):
-                return_dict[notification] = notification.get_user_prefs(user)
+        for notification in notifications:
+            bitmap = bitmaps[(notification.pk, user.pk)]
+            return_dict[notification] = dict(
+                (backend, bool(bitmap & (1 << backend.pk)))
+                for backend in notification.backends.all() if backend.enabled
+            )
         return return_dict
 
 
@@ -40,4 +73,233 @@ class UserPrefsManager(models.Manager):
         for user in users:
             user_filter = Q(user_filter | Q(user=user))
 
-        self.filter(user_filter).delete()
+        # Imported here, notifier.models imports this module
+        from notifier.models import deferred_invalidation
+        with deferred_invalidation():
+            self.filter(user_filter).delete()
+
+
+def _unread_cache_key(user_id):
+    return 'notifier:unread:%s' % user_id
+
+
+# Seconds a placeholder is kept while a counter is counted from the database
+UNREAD_COUNTING_TIMEOUT = 60
+
+
+class SentNotificationManager(models.Manager):
+    """
+    Keeps the number of unread notifications of every user in the cache.
+    The counters are updated by `bulk_create`, `create`, `mark_read` and
+    `mark_all_read`. A counter missing from the cache is counted again.
+    """
+    def unread_count(self, user):
+        """
+        Number of unread notifications of the user (object or id), counted
+        from the ``(user, read, created)`` index if not cached.
+        """
+        user_id = getattr(user, 'pk', user)
+        key = _unread_cache_key(user_id)
+        count = cache.get(key)
+        if isinstance(count, (int, long)):
+            return count
+
+        # Keep a placeholder in the cache while counting. Updates of the
+        # counter in the meantime fail on it and remove it, then the count
+        # is not stored and the next call counts again.
+        token = 'counting:%s' % uuid4().hex
+        counting = count is None and cache.add(key, token,
+            UNREAD_COUNTING_TIMEOUT)
+        count = self.filter(user=user_id, read=False).count()
+        if counting and cache.get(key) == token:
+            cache.set(key, count, notifier_settings.UNREAD_CACHE_TIMEOUT)
+        return count
+
+    def inbox(self, user, cursor=None, limit=20, unread=False):
+        """
+        Returns a page of at most `limit` notifications of the user, newest
+        first, and the cursor of the next page, None on the last page.
+
+        Pass the cursor of the previous page to get the next one. Pages are
+        selected by ``(created, id)`` instead of an offset, so deep pages
+        are as fast as the first. `unread` only includes unread ones.
+        """
+        queryset = self.filter(user=getattr(user, 'pk', user))
+        if unread:
+            queryset = queryset.filter(read=False)
+        if cursor is not None:
+            created, pk = cursor
+            queryset = queryset.filter(Q(created__lt=created) |
+                Q(created=created, pk__lt=pk))
+
+        page = list(queryset.select_related('notification', 'backend')
+            .order_by('-created', '-pk')[:limit + 1])
+        if len(page) <= limit:
+            return page, None
+        page = page[:limit]
+        return page, (page[-1].created, page[-1].pk)
+
+    def mark_read(self, user, ids=None, before=None):
+        """
+        Mark notifications of the user as read with a single UPDATE: the
+        ones with primary keys `ids`, the ones created before the datetime
+        `before`, or both.
+
+        Returns the number of notifications that were unread.
+        """
+        if ids is None and before is None:
+            raise ValueError('Pass ids, before or both')
+        user_id = getattr(user, 'pk', user)
+        queryset = self.filter(user=user_id, read=False)
+        if ids is not None:
+            queryset = queryset.filter(pk__in=ids)
+        if before is not None:
+            queryset = queryset.filter(created__lt=before)
+        count = queryset.update(read=True)
+        if count:
+            self._change_unread_count(user_id, -count)
+        return count
+
+    def mark_all_read(self, user):
+        """
+        Mark all notifications of the user as read.
+
+        Returns the number of notifications that were unread.
+        """
+        user_id = getattr(user, 'pk', user)
+        count = self.filter(user=user_id, read=False).update(read=True)
+        cache.set(_unread_cache_key(user_id), 0,
+            notifier_settings.UNREAD_CACHE_TIMEOUT)
+        return count
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super(SentNotificationManager, self).bulk_create(objs, *args,
+            **kwargs)
+        self.count_unread(objs)
+        return objs
+
+    def count_unread(self, objs):
+        """
+        Add the unread notifications in `objs` to the cached counters.
+        """
+        counts = defaultdict(int)
+        for obj in objs:
+            if not obj.read:
+                counts[obj.user_id] += 1
+        for user_id, count in counts.items():
+            self._change_unread_count(user_id, count)
+
+    def invalidate_unread_counts(self, user_ids):
+        """
+        Remove the cached counters of the users, e.g. after deleting or
+        updating notifications without `mark_read`.
+        """
+        cache.delete_many([_unread_cache_key(user_id)
+            for user_id in user_ids])
+
+    def _change_unread_count(self, user_id, delta):
+        key = _unread_cache_key(user_id)
+        try:
+            count = cache.incr(key, delta)
+        except (ValueError, TypeError):
+            # Not cached or being counted, counted on the next unread_count
+            cache.delete(key)
+            return
+        if count < 0:
+            cache.delete(key)
+
+
+class QueuedNotificationManager(models.Manager):
+    def enqueue(self, notification, users, context=None, backend=None,
+            delay=None, idempotency_key=None):
+        """
+        Add a send of `notification` to `users` to the queue, only with
+        `backend` if given and not before `delay` seconds if given.
+
+        `context` has to be serializable to JSON.
+        """
+        if isinstance(users, QuerySet):
+            user_ids = list(users.values_list('pk', flat=True))
+        else:
+            if not isinstance(users, Iterable):
+                users = [users]
+            user_ids = [user.pk for user in users]
+
+        return self.create(
+            notification=notification,
+            users=json.dumps(user_ids),
+            context=json.dumps(context or {}, cls=DjangoJSONEncoder),
+            backend=backend,
+            available=now() + timedelta(seconds=delay) if delay else None,
+            idempotency_key=idempotency_key
+        )
+
+    def claim(self, worker, limit=10, timeout=None):
+        """
+        Lock up to `limit` pending sends for `worker` and return them.
+
+        Claiming is a single conditional UPDATE, so a send can only be
+        claimed by one worker even with several workers on different
+        machines. Sends that were claimed more than `timeout` seconds ago
+        and never finished are put back in the queue first.
+        """
+        if timeout is not None:
+            self.filter(
+                status=self.model.PROCESSING,
+                locked__lt=now() - timedelta(seconds=timeout)
+            ).update(status=self.model.PENDING, worker=None, locked=None)
+
+        pending = list(self.filter(
+            Q(available__isnull=True) | Q(available__lte=now()),
+            status=self.model.PENDING
+        ).order_by('pk').values_list('pk', flat=True)[:limit])
+        if not pending:
+            return []
+
+        token = '%s:%s' % (worker, uuid4().hex)
+        self.filter(pk__in=pending, status=self.model.PENDING).update(
+            status=self.model.PROCESSING, worker=token, locked=now())
+
+        return list(self.filter(worker=token).order_by('pk').select_related(
+            'notification'))
+
+
+def retry_delay(attempts):
+    """
+    Seconds to wait after `attempts` failed attempts: exponential backoff
+    capped at NOTIFIER_RETRY_MAX_DELAY, with jitter.
+    """
+    delay = min(notifier_settings.RETRY_MAX_DELAY,
+        notifier_settings.RETRY_DELAY * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+class FailedDeliveryManager(models.Manager):
+    def add(self, notification, backend, users, context):
+        """
+        Store the failed delivery of `notification` with `backend` to
+        `users` for a retry. `context` is JSON encoded.
+        """
+        next_attempt = now() + timedelta(seconds=retry_delay(1))
+        return self.bulk_create([
+            self.model(user_id=user.pk, notification=notification,
+                backend=backend, context=context, next_attempt=next_attempt)
+            for user in users
+        ])
+
+    def due(self, limit):
+        """
+        Up to `limit` pending retries whose next attempt is due, oldest
+        first.
+        """
+        return list(self.filter(status=self.model.PENDING,
+            next_attempt__lte=now()).order_by('next_attempt', 'pk')
+            .select_related('notification', 'backend', 'user')[:limit])
+
+    def requeue_dead(self):
+        """
+        Retry dead deliveries again as soon as possible, with as many
+        attempts as a new failure. Returns the number requeued.
+        """
+        return self.filter(status=self.model.DEAD).update(
+            status=self.model.PENDING, attempts=1, next_attempt=now())
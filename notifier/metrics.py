@@ -0,0 +1,238 @@
+###############################################################################
+## Imports
+###############################################################################
+# Python
+from contextlib import contextmanager
+from importlib import import_module
+from threading import Lock
+from time import time
+
+# Django
+from django.conf import settings
+from django.dispatch import Signal
+
+
+###############################################################################
+## Settings
+###############################################################################
+# Dotted paths of the metric sink classes. Defined here rather than in
+# notifier.settings, which imports the backend classes.
+METRIC_SINKS = getattr(settings, 'NOTIFIER_METRIC_SINKS', ())
+
+
+###############################################################################
+## Signals
+###############################################################################
+# Sent after a phase of a send has been timed. Phases are `send` (all of
+# `Notification.send`), `resolve` (preferences of a chunk of users), `deliver`
+# (the backend class sending to a list of users, including `render`), `render`
+# (one template) and `record` (inserting `SentNotification` records).
+phase_timed = Signal(providing_args=['phase', 'notification', 'backend',
+    'seconds', 'count'])
+
+# Sent when the results of deliveries with a backend are recorded
+deliveries_recorded = Signal(providing_args=['notification', 'backend',
+    'succeeded', 'failed'])
+
+
+###############################################################################
+## Sinks
+###############################################################################
+_sinks = None
+
+
+def get_sinks():
+    """
+    Returns the instances of the sinks in NOTIFIER_METRIC_SINKS, created
+    once per process.
+    """
+    global _sinks
+    if _sinks is None:
+        sinks = []
+        for path in METRIC_SINKS:
+            module, klass = path.rsplit('.', 1)
+            sinks.append(getattr(import_module(module), klass)())
+        _sinks = sinks
+    return _sinks
+
+
+def get_sink(klass):
+    """
+    Returns the configured sink that is an instance of `klass`, or None.
+    """
+    for sink in get_sinks():
+        if isinstance(sink, klass):
+            return sink
+    return None
+
+
+class BaseSink(object):
+    """
+    Receives the metrics of this process. Called from the thread doing the
+    work, which may be a dispatcher thread.
+    """
+    def timing(self, phase, notification, backend, seconds, count):
+        pass
+
+    def deliveries(self, notification, backend, succeeded, failed):
+        pass
+
+
+class MemorySink(BaseSink):
+    """
+    Keeps totals per phase and per backend in memory, for the exporter view
+    and for tests.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # (phase, notification, backend): [count, seconds]
+            self.timings = {}
+            # (notification, backend): [succeeded, failed]
+            self.delivered = {}
+
+    def timing(self, phase, notification, backend, seconds, count):
+        with self.lock:
+            totals = self.timings.setdefault(
+                (phase, notification, backend), [0, 0.0])
+            totals[0] += count
+            totals[1] += seconds
+
+    def deliveries(self, notification, backend, succeeded, failed):
+        with self.lock:
+            totals = self.delivered.setdefault((notification, backend), [0, 0])
+            totals[0] += succeeded
+            totals[1] += failed
+
+    def success_rate(self, backend):
+        """
+        Returns the share of successful deliveries with `backend`, None
+        before the first delivery.
+        """
+        succeeded = failed = 0
+        with self.lock:
+            for (notification, name), totals in self.delivered.items():
+                if name == backend:
+                    succeeded += totals[0]
+                    failed += totals[1]
+        if not succeeded + failed:
+            return None
+        return float(succeeded) / (succeeded + failed)
+
+
+###############################################################################
+## Code
+###############################################################################
+def _name(obj):
+    return getattr(obj, 'name', obj) or ''
+
+
+def is_enabled():
+    return bool(get_sinks()) or phase_timed.has_listeners() or \
+        deliveries_recorded.has_listeners()
+
+
+class Timer(object):
+    """
+    Yielded by `timed`. `count` can be set before the block ends, e.g. when
+    the number of items is only known afterwards.
+    """
+    def __init__(self, count):
+        self.count = count
+
+
+@contextmanager
+def timed(phase, notification=None, backend=None, count=1):
+    """
+    Time the `with` block as `phase` and pass the result to the sinks and
+    `phase_timed` receivers. Nothing is timed when neither are configured.
+    """
+    timer = Timer(count)
+    if not is_enabled():
+        yield timer
+        return
+
+    start = time()
+    yield timer
+    seconds = time() - start
+
+    notification, backend = _name(notification), _name(backend)
+    for sink in get_sinks():
+        sink.timing(phase, notification, backend, seconds, timer.count)
+    phase_timed.send(sender=None, phase=phase, notification=notification,
+        backend=backend, seconds=seconds, count=timer.count)
+
+
+def record_deliveries(notification, backend, results):
+    """
+    Count the ``(user, success)`` tuples in `results` delivered with
+    `backend`.
+    """
+    if not results or not is_enabled():
+        return
+    succeeded = len([success for (user, success) in results if success])
+    failed = len(results) - succeeded
+
+    notification, backend = _name(notification), _name(backend)
+    for sink in get_sinks():
+        sink.deliveries(notification, backend, succeeded, failed)
+    deliveries_recorded.send(sender=None, notification=notification,
+        backend=backend, succeeded=succeeded, failed=failed)
+
+
+###############################################################################
+## Prometheus
+###############################################################################
+def _labels(**labels):
+    return ','.join('%s="%s"' % (key, unicode(value).replace('\\', '\\\\')
+        .replace('"', '\\"').replace('\n', '\\n'))
+        for (key, value) in sorted(labels.items()))
+
+
+def render_prometheus(sink=None, queue_depths=None):
+    """
+    Returns the totals of a `MemorySink` and the queue depths from
+    `notifier.models.get_queue_depths` in the Prometheus text format.
+    """
+    lines = []
+    if sink is not None:
+        with sink.lock:
+            timings = sorted(sink.timings.items())
+            delivered = sorted(sink.delivered.items())
+
+        lines.append('# HELP notifier_phase_seconds_total Seconds spent in '
+            'each phase of sending.')
+        lines.append('# TYPE notifier_phase_seconds_total counter')
+        for (phase, notification, backend), totals in timings:
+            lines.append('notifier_phase_seconds_total{%s} %r' % (_labels(
+                phase=phase, notification=notification, backend=backend),
+                totals[1]))
+        lines.append('# HELP notifier_phase_items_total Items handled in '
+            'each phase of sending.')
+        lines.append('# TYPE notifier_phase_items_total counter')
+        for (phase, notification, backend), totals in timings:
+            lines.append('notifier_phase_items_total{%s} %d' % (_labels(
+                phase=phase, notification=notification, backend=backend),
+                totals[0]))
+
+        lines.append('# HELP notifier_deliveries_total Recorded deliveries.')
+        lines.append('# TYPE notifier_deliveries_total counter')
+        for (notification, backend), totals in delivered:
+            for result, value in (('success', totals[0]),
+                    ('failure', totals[1])):
+                lines.append('notifier_deliveries_total{%s} %d' % (_labels(
+                    notification=notification, backend=backend,
+                    result=result), value))
+
+    if queue_depths is not None:
+        lines.append('# HELP notifier_queue_depth Entries waiting in each '
+            'queue.')
+        lines.append('# TYPE notifier_queue_depth gauge')
+        for queue, depth in sorted(queue_depths.items()):
+            lines.append('notifier_queue_depth{%s} %d' % (_labels(
+                queue=queue), depth))
+
+    return '\n'.join(lines) + '\n'
@@ -2,21 +2,165 @@
 ## Imports
 ###############################################################################
 # Python
-from collections import Iterable
+from collections import defaultdict, Iterable
+from contextlib import contextmanager
+from datetime import timedelta
 from importlib import import_module
+import json
+import logging
+from threading import local
+from time import time
 
 # Django
 from django.contrib.auth.models import User, Group, Permission
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from django.db import models
-from django.db.models import Q
-from django.db.models.signals import pre_delete
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, models, transaction
+from django.db.models.query import QuerySet
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+    pre_delete)
 from django.dispatch import receiver
+from django.template import Context
 from django.utils.timezone import now
 
 # User
+from notifier import backends as notifier_backends
+from notifier import dispatch
 from notifier import managers
+from notifier import metrics
+from notifier import ratelimit
+from notifier import settings as notifier_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+###############################################################################
+## Backend Classes
+###############################################################################
+# Backend classes by dotted path, starting with the classes imported from
+# NOTIFIER_BACKENDS. Other classes are added when first used.
+BACKEND_CLASSES = dict(
+    ('.'.join([klass.__module__, klass.__name__]), klass)
+    for klass in notifier_settings.BACKEND_CLASSES
+)
+
+
+def get_backend_class(path):
+    try:
+        return BACKEND_CLASSES[path]
+    except KeyError:
+        module, klass = path.rsplit('.', 1)
+        backendclass = BACKEND_CLASSES[path] = getattr(
+            import_module(module), klass)
+        return backendclass
+
+
+###############################################################################
+## Helpers
+###############################################################################
+def _iter_user_chunks(users, chunk_size):
+    """
+    Yields lists of at most `chunk_size` users. Sliced querysets cannot be
+    reordered or filtered, they are read as they are.
+    """
+    if isinstance(users, QuerySet) and not (users.query.low_mark or
+            users.query.high_mark is not None):
+        users = users.order_by('pk')
+        if notifier_settings.SEND_USER_FIELDS:
+            users = users.only(*notifier_settings.SEND_USER_FIELDS)
+
+        chunk = list(users[:chunk_size].iterator())
+        while chunk:
+            yield chunk
+            chunk = list(users.filter(
+                pk__gt=chunk[-1].pk)[:chunk_size].iterator())
+        return
+
+    if not isinstance(users, Iterable):
+        users = [users]
+
+    chunk = []
+    for user in users:
+        chunk.append(user)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+###############################################################################
+## Preference Cache
+###############################################################################
+# Hits and misses of the preference cache in this process
+PREFS_CACHE_STATS = {'hits': 0, 'misses': 0}
+
+
+def get_prefs_cache_stats():
+    return dict(PREFS_CACHE_STATS)
+
+
+def reset_prefs_cache_stats():
+    PREFS_CACHE_STATS.update(hits=0, misses=0)
+
+
+def _prefs_cache_key(notification_id, user_id):
+    return 'notifier:prefs:%s:%s' % (notification_id, user_id)
+
+
+def _backends_cache_key(notification_id):
+    return 'notifier:backends:%s' % notification_id
+
+
+# Preferences to invalidate at the end of `deferred_invalidation` blocks,
+# per thread
+_deferred = local()
+
+
+@contextmanager
+def deferred_invalidation():
+    """
+    Collect the `invalidate_prefs` calls in the `with` block, e.g. from the
+    signals of every row of a `QuerySet.delete`, and apply them once per
+    notification at the end.
+    """
+    if getattr(_deferred, 'pending', None) is not None:
+        yield
+        return
+
+    _deferred.pending = pending = defaultdict(set)
+    try:
+        yield
+    finally:
+        _deferred.pending = None
+    for notification_id, user_ids in pending.items():
+        invalidate_prefs([notification_id], user_ids)
+
+
+def invalidate_prefs(notification_ids, user_ids):
+    """
+    Remove the cached preferences of the users for the notifications and
+    update their `EffectivePrefs` if enabled. Only needed after changing
+    preferences without signals, e.g. with `update`.
+    """
+    pending = getattr(_deferred, 'pending', None)
+    if pending is not None:
+        user_ids = list(user_ids)
+        for notification_id in notification_ids:
+            pending[notification_id].update(user_ids)
+        return
+
+    if notifier_settings.EFFECTIVE_PREFS:
+        refresh_effective_prefs(notification_ids, user_ids)
+    cache.delete_many([_prefs_cache_key(notification_id, user_id)
+        for notification_id in notification_ids for user_id in user_ids])
+
+
+def _invalidate_backends(notification_ids):
+    cache.delete_many([_backends_cache_key(notification_id)
+        for notification_id in notification_ids])
 
 
 ###############################################################################
@@ -58,25 +202,118 @@ class Backend(BaseModel):
         """
         Return the python class from the string value in `self.klass`
         """
-        module, klass = self.klass.rsplit('.', 1)
-        return getattr(import_module(module), klass)
+        return get_backend_class(self.klass)
     backendclass = property(_get_backendclass)
 
-    def send(self, user, notification, context=None):
+    def send(self, user, notification, context=None, writer=None):
         """
         Send the notification to the specified user using this backend.
 
+        If a `SentNotificationWriter` is given, the `SentNotification` record
+        is buffered in it instead of being saved immediately.
+
         returns Boolean according to success of delivery.
         """
 
         backendobject = self.backendclass(notification)
-        sent_success = backendobject.send(user, context)
+        with metrics.timed('deliver', notification, self):
+            sent_success = backendobject.send(user, context)
+        metrics.record_deliveries(notification, self, [(user, sent_success)])
 
-        SentNotification.objects.create(user=user, notification=notification,
-            backend=self, success=sent_success)
+        sentnotification = SentNotification(user=user,
+            notification=notification, backend=self, success=sent_success)
+        if writer is None:
+            sentnotification.save()
+        else:
+            writer.add(sentnotification)
 
         return sent_success
 
+    def send_many(self, users, notification, context=None, writer=None):
+        """
+        Send the notification to all `users` using this backend and record
+        the results.
+
+        returns a list of ``(user, success)`` tuples.
+        """
+        results = self.deliver(users, notification, context)
+        self.record(results, notification, writer)
+        return results
+
+    def deliver(self, users, notification, context=None, digest=False,
+            contexts=None, idempotency_key=None):
+        """
+        Send the notification to all `users` with one call to `send_many`
+        of the backend class, without recording the results. `digest` uses
+        the digest templates. `contexts` is passed to `send_many`.
+        Deliveries deferred by a rate limit keep `idempotency_key`.
+
+        returns a list of ``(user, success)`` tuples.
+        """
+        if not isinstance(context, Context):
+            context = notifier_backends.get_context(context)
+
+        backendobject = self.backendclass(notification, digest=digest)
+        # Only passed when given, for backends overriding `send_many`
+        kwargs = {} if contexts is None else {'contexts': contexts}
+        bucket = ratelimit.get_bucket(self.name)
+        if bucket is None:
+            with metrics.timed('deliver', notification, self) as timer:
+                results = backendobject.send_many(users, context, **kwargs)
+                timer.count = len(results)
+            return results
+
+        users = list(users)
+        results = []
+        for start in range(0, len(users), bucket.burst):
+            batch = users[start:start + bucket.burst]
+            # Digests are not queued, they always wait
+            if not bucket.defer or digest:
+                bucket.acquire(len(batch))
+            else:
+                wait = bucket.take(len(batch), reserve=False)
+                if wait:
+                    self.defer(users[start:], notification, context, wait,
+                        idempotency_key)
+                    break
+            with metrics.timed('deliver', notification, self, len(batch)):
+                results.extend(backendobject.send_many(batch, context,
+                    **kwargs))
+        return results
+
+    def defer(self, users, notification, context, seconds,
+            idempotency_key=None):
+        """
+        Add the delivery of the notification to `users` with this backend
+        to the queue, to be sent in `seconds` seconds at the earliest.
+        """
+        QueuedNotification.objects.enqueue(notification, users,
+            notifier_backends.get_context_data(context), backend=self,
+            delay=seconds, idempotency_key=idempotency_key)
+        ratelimit._record(self.name, deferred=len(users))
+
+    def record(self, results, notification, writer=None,
+            idempotency_key=None):
+        """
+        Create `SentNotification` records for the ``(user, success)``
+        tuples in `results`. Only successful deliveries keep
+        `idempotency_key`, so failed ones are sent again with the same key.
+        """
+        sentnotifications = [
+            SentNotification(user=user, notification=notification,
+                backend=self, success=sent_success,
+                idempotency_key=idempotency_key if sent_success else None)
+            for (user, sent_success) in results
+        ]
+        metrics.record_deliveries(notification, self, results)
+        if writer is None:
+            with metrics.timed('record', notification, self,
+                    len(sentnotifications)):
+                _bulk_create_new(SentNotification, sentnotifications)
+        else:
+            for sentnotification in sentnotifications:
+                writer.add(sentnotification)
+
 
 class Notification(BaseModel):
     """
@@ -107,123 +344,379 @@ class Notification(BaseModel):
     def check_perms(self, user):
         # Need an iterable with permission strings to check using has_perms.
         # This makes it possible to take advantage of the cache.
+        if 'permissions' in getattr(self, '_prefetched_objects_cache', {}):
+            permissions = self.permissions.all()
+        else:
+            permissions = self.permissions.select_related('content_type')
         perm_list = set(
-            ["%s.%s" % (p.content_type.app_label, p.codename) for p in self.permissions.select_related()]
+            ["%s.%s" % (p.content_type.app_label, p.codename) for p in permissions]
         )
 
         if not user.has_perms(perm_list):
             return False
         return True
 
+    def get_enabled_backends(self):
+        """
+        Returns a list of the enabled backends for this notification.
+
+        The list is cached until the backends of the notification or
+        the backends themselves change.
+        """
+        key = _backends_cache_key(self.pk)
+        backends = cache.get(key)
+        if backends is None:
+            backends = list(self.backends.filter(enabled=True))
+            cache.set(key, backends, notifier_settings.PREFS_CACHE_TIMEOUT)
+        return backends
+
+    def get_prefs_bitmaps(self, users):
+        """
+        Returns a dictionary with user id as key and a bitmap of the backend
+        ids selected by the `User` and `Group` preferences of that user as
+        value. Bit ``1 << backend.pk`` is set if the backend is selected.
+
+        `users` is a list of users or a queryset. Bitmaps are cached until
+        the preferences or group memberships of the user change, bitmaps
+        that are not cached are computed in a constant number of queries.
+        """
+        return dict((user_id, bitmap) for ((notification_id, user_id), bitmap)
+            in self.get_prefs_bitmaps_many([self.pk], users).items())
+
+    @classmethod
+    def get_prefs_bitmaps_many(cls, notification_ids, users):
+        """
+        `get_prefs_bitmaps` for several notifications at once. Returns a
+        dictionary with ``(notification id, user id)`` as key.
+        """
+        if isinstance(users, QuerySet):
+            user_filter = users.values('pk')
+        else:
+            user_filter = None
+
+        keys = dict(
+            (_prefs_cache_key(notification_id, user.pk),
+                (notification_id, user.pk))
+            for notification_id in notification_ids for user in users
+        )
+        bitmaps = dict((keys[key], bitmap) for (key, bitmap)
+            in cache.get_many(keys.keys()).items())
+
+        missing = [key for key in keys.values() if key not in bitmaps]
+        PREFS_CACHE_STATS['hits'] += len(bitmaps)
+        PREFS_CACHE_STATS['misses'] += len(missing)
+
+        if missing:
+            missing_notifications = set(key[0] for key in missing)
+            missing_users = set(key[1] for key in missing)
+            if user_filter is None or bitmaps:
+                user_filter = missing_users
+            computed = cls._compute_prefs_bitmaps(missing_notifications,
+                user_filter, missing_users)
+            cache.set_many(
+                dict((_prefs_cache_key(*key), bitmap)
+                    for (key, bitmap) in computed.items()),
+                notifier_settings.PREFS_CACHE_TIMEOUT
+            )
+            bitmaps.update(computed)
+
+        return bitmaps
+
+    @classmethod
+    def _compute_prefs_bitmaps(cls, notification_ids, user_filter, user_ids):
+        """
+        Read the bitmaps from `EffectivePrefs` if enabled, otherwise resolve
+        them from the preferences.
+        """
+        if not notifier_settings.EFFECTIVE_PREFS:
+            return cls._resolve_prefs_bitmaps(notification_ids, user_filter,
+                user_ids)
+
+        bitmaps = dict.fromkeys(((notification_id, user_id)
+            for notification_id in notification_ids
+            for user_id in user_ids), 0)
+        selected = EffectivePrefs.objects.filter(
+            notification__in=notification_ids,
+            user__in=user_filter
+        ).values_list('notification_id', 'user_id', 'backend_id')
+        for notification_id, user_id, backend_id in selected:
+            bitmaps[(notification_id, user_id)] |= 1 << backend_id
+        return bitmaps
+
+    @classmethod
+    def _resolve_prefs_bitmaps(cls, notification_ids, user_filter, user_ids):
+        """
+        UserPrefs supercede GroupPrefs, a backend is selected by the groups
+        if any group of the user has notify set to True for it.
+        """
+        group_settings = GroupPrefs.objects.filter(
+            notification__in=notification_ids,
+            notify=True
+        ).values_list('notification_id', 'group_id', 'backend_id')
+        group_bitmaps = defaultdict(lambda: defaultdict(int))
+        for notification_id, group_id, backend_id in group_settings:
+            group_bitmaps[group_id][notification_id] |= 1 << backend_id
+
+        bitmaps = dict.fromkeys(((notification_id, user_id)
+            for notification_id in notification_ids
+            for user_id in user_ids), 0)
+
+        if group_bitmaps:
+            memberships = User.groups.through.objects.filter(
+                user__in=user_filter,
+                group__in=group_bitmaps.keys()
+            ).values_list('user_id', 'group_id')
+            for user_id, group_id in memberships:
+                for notification_id, bitmap in group_bitmaps[group_id].items():
+                    bitmaps[(notification_id, user_id)] |= bitmap
+
+        user_settings = UserPrefs.objects.filter(
+            notification__in=notification_ids,
+            user__in=user_filter
+        ).values_list('notification_id', 'user_id', 'backend_id', 'notify')
+        for notification_id, user_id, backend_id, notify in user_settings:
+            if notify:
+                bitmaps[(notification_id, user_id)] |= 1 << backend_id
+            else:
+                bitmaps[(notification_id, user_id)] &= ~(1 << backend_id)
+
+        return bitmaps
+
     def get_backends(self, user):
         """
         Returns backends after checking `User` and `Group` preferences
         as well as `backend.enabled` flag.
         """
-        user_settings = self.userprefs_set.filter(user=user)
-        group_filter = Q()
-        for group in user.groups.all():
-            group_filter = Q(group_filter | Q(group=group))
+        bitmap = self.get_prefs_bitmaps([user])[user.pk]
+        return self.backends.filter(enabled=True, id__in=[
+            backend.pk for backend in self.get_enabled_backends()
+            if bitmap & (1 << backend.pk)
+        ])
+
+    def get_backends_bulk(self, users):
+        """
+        Returns a list of ``(user, backends)`` tuples for all `users` that
+        should receive this notification, applying the same rules as
+        `get_backends`. Users without any selected backend are skipped.
 
-        group_settings = self.groupprefs_set.filter(group_filter)
+        The number of queries is constant regardless of the number of users.
+        """
+        backends = self.get_enabled_backends()
+        if not backends:
+            return []
 
-        backends = self.backends.filter(enabled=True)
+        if isinstance(users, QuerySet):
+            users = users.all()
+        else:
+            if not isinstance(users, Iterable):
+                users = [users]
+            users = list(users)
 
-        remove_backends = []
-        for backend in backends:
-            try:
-                userprefs = user_settings.get(backend=backend)
-            except UserPrefs.DoesNotExist:
-                try:
-                    group_settings.get(backend=backend, notify=True)
-                except GroupPrefs.DoesNotExist:
-                    remove_backends.append(backend.id)
-            else:
-                if not userprefs.notify:
-                    remove_backends.append(backend.id)
+        bitmaps = self.get_prefs_bitmaps(users)
 
-        return backends.exclude(id__in=remove_backends)
+        recipients = []
+        for user in users:
+            selected = [backend for backend in backends
+                if bitmaps[user.pk] & (1 << backend.pk)]
+            if selected:
+                recipients.append((user, selected))
+
+        return recipients
 
     def get_user_prefs(self, user):
         """
         Return a dictionary of all available backend methods with True
         or False values depending on preferences.
         """
-        all_backends = self.backends.filter(enabled=True)
-        selected_backends = self.get_backends(user)
-
-        backend_dict = dict(zip(all_backends, [False] * len(all_backends)))
-        for backend in all_backends:
-            if backend in selected_backends:
-                backend_dict[backend] = True
-
-        return backend_dict
+        bitmap = self.get_prefs_bitmaps([user])[user.pk]
+        return dict((backend, bool(bitmap & (1 << backend.pk)))
+            for backend in self.get_enabled_backends())
 
     def update_user_prefs(self, user, prefs_dict):
         """
         Update or create a `UserPrefs` instance as required
         """
-        result = {}
-        for backend, value in prefs_dict.items():
-            if not isinstance(backend, Backend):
-                backend = Backend.objects.get(name=backend)
-
-            try:
-                userpref = self.userprefs_set.get(
-                    user=user,
-                    backend=backend
-                )
-            except UserPrefs.DoesNotExist:
-                UserPrefs.objects.create(
-                    user=user,
-                    notification=self,
-                    backend=backend,
-                    notify=value
-                )
-                result[backend.name] = 'created'
-            else:
-                if userpref.notify != value:
-                    userpref.notify = value
-                    userpref.save()
-                    result[backend.name] = 'updated'
-        return result
+        return self._update_prefs(UserPrefs, 'user', user, prefs_dict)
 
     def update_group_prefs(self, group, prefs_dict):
         """
         Update or create a `GroupPrefs` instance as required
         """
-        result = {}
+        return self._update_prefs(GroupPrefs, 'group', group, prefs_dict)
+
+    def _update_prefs(self, model, owner_field, owner, prefs_dict):
+        """
+        Create and update the `model` preferences of `owner` for this
+        notification, with a number of queries that does not depend on the
+        number of backends in `prefs_dict`.
+
+        Returns a dict with backend names that were created or updated.
+        """
+        names = [backend for backend in prefs_dict
+            if not isinstance(backend, Backend)]
+        named = {}
+        if names:
+            named = dict((backend.name, backend)
+                for backend in Backend.objects.filter(name__in=names))
+
+        values = {}
         for backend, value in prefs_dict.items():
             if not isinstance(backend, Backend):
-                backend = Backend.objects.get(name=backend)
+                try:
+                    backend = named[backend]
+                except KeyError:
+                    raise Backend.DoesNotExist(
+                        'Backend %s does not exist.' % backend)
+            values[backend] = value
 
-            try:
-                grouppref = self.groupprefs_set.get(
-                    group=group,
-                    backend=backend
-                )
-            except GroupPrefs.DoesNotExist:
-                GroupPrefs.objects.create(
-                    group=group,
-                    notification=self,
-                    backend=backend,
-                    notify=value
-                )
+        existing = dict((pref.backend_id, pref)
+            for pref in model.objects.filter(notification=self,
+                backend__in=list(values), **{owner_field: owner}))
+
+        result = {}
+        created = []
+        updates = defaultdict(list)
+        for backend, value in values.items():
+            pref = existing.get(backend.pk)
+            if pref is None:
+                created.append(model(notification=self, backend=backend,
+                    notify=value, **{owner_field: owner}))
                 result[backend.name] = 'created'
+            elif pref.notify != value:
+                updates[value].append(pref.pk)
+                result[backend.name] = 'updated'
+
+        if (result and model is UserPrefs and
+                not self.check_perms(owner)):
+            raise PermissionDenied
+        if created:
+            model.objects.bulk_create(created)
+        for value, pks in updates.items():
+            model.objects.filter(pk__in=pks).update(notify=value,
+                updated=now())
+
+        if result:
+            if model is UserPrefs:
+                user_ids = [owner.pk]
             else:
-                if grouppref.notify != value:
-                    grouppref.notify = value
-                    grouppref.save()
-                    result[backend.name] = 'updated'
+                user_ids = User.groups.through.objects.filter(
+                    group=owner.pk).values_list('user_id', flat=True)
+            invalidate_prefs([self.pk], user_ids)
         return result
 
-    def send(self, users, context=None):
-        if not isinstance(users, Iterable):
-            users = [users]
+    def get_digest_window(self, backend):
+        """
+        Seconds that deliveries with `backend` are buffered for digests,
+        None if they are sent immediately.
+        """
+        return notifier_settings.DIGESTS.get(self.name, {}).get(backend.name)
 
-        for user in users:
-            for backend in self.get_backends(user):
-                backend.send(user, self, context)
+    def _skip_sent(self, backend_users, idempotency_key):
+        """
+        Remove the users that already have a `SentNotification` with
+        `idempotency_key` for a backend from `backend_users`, with a single
+        query.
+        """
+        sent = set(SentNotification.objects.filter(
+            idempotency_key=idempotency_key,
+            backend__in=list(backend_users),
+            user__in=set(user.pk for users in backend_users.values()
+                for user in users)
+        ).values_list('backend_id', 'user_id'))
+        if not sent:
+            return
+        for backend in list(backend_users):
+            users = [user for user in backend_users[backend]
+                if (backend.pk, user.pk) not in sent]
+            if users:
+                backend_users[backend] = users
+            else:
+                del backend_users[backend]
+
+    def send(self, users, context=None, dispatcher=None, backends=None,
+            idempotency_key=None):
+        """
+        Send the notification to `users`, a user, an iterable of users or a
+        queryset. `backends` limits the backends used to the given ones.
+        With `idempotency_key`, users that already have a successful
+        `SentNotification` with the key for a backend are skipped for that
+        backend.
+
+        Users are handled in chunks of NOTIFIER_SEND_CHUNK_SIZE. Querysets
+        are read one chunk at a time in primary key order. `dispatcher`
+        delivers the chunks, it defaults to the one configured with
+        NOTIFIER_DISPATCH_THREADS and is closed when the send is complete.
+
+        Deliveries with backends that have a digest window are buffered as
+        `DigestItem` records instead. Failed deliveries are stored as
+        `FailedDelivery` records if NOTIFIER_RETRY_ATTEMPTS allows retries
+        and the context can be encoded as JSON.
+        """
+        # Shared by all recipients and backends
+        if not isinstance(context, Context):
+            context = notifier_backends.get_context(context)
+        # JSON encoded context for digests and retries, encoded once
+        stored_context = None
+        retry = notifier_settings.RETRY_ATTEMPTS > 1
+
+        if dispatcher is None:
+            dispatcher = dispatch.get_dispatcher()
+        try:
+            with metrics.timed('send', self), \
+                    SentNotificationWriter() as writer:
+                for chunk in _iter_user_chunks(users,
+                        notifier_settings.SEND_CHUNK_SIZE):
+                    backend_users = defaultdict(list)
+                    with metrics.timed('resolve', self, count=len(chunk)):
+                        recipients = self.get_backends_bulk(chunk)
+                    for user, selected in recipients:
+                        for backend in selected:
+                            if backends is None or backend in backends:
+                                backend_users[backend].append(user)
+                    if idempotency_key is not None and backend_users:
+                        self._skip_sent(backend_users, idempotency_key)
+
+                    items = []
+                    for backend in list(backend_users):
+                        if not self.get_digest_window(backend):
+                            continue
+                        if stored_context is None:
+                            stored_context = json.dumps(
+                                notifier_backends.get_context_data(context),
+                                cls=DjangoJSONEncoder)
+                        items.extend(DigestItem(user_id=user.pk,
+                            notification=self, backend=backend,
+                            context=stored_context)
+                            for user in backend_users.pop(backend))
+                    if items:
+                        DigestItem.objects.bulk_create(items)
+
+                    for backend, results in dispatcher.deliver(
+                            backend_users, self, context, idempotency_key):
+                        backend.record(results, self, writer,
+                            idempotency_key)
+
+                        failed = [user for (user, success) in results
+                            if not success]
+                        if not failed or not retry:
+                            continue
+                        if stored_context is None:
+                            try:
+                                stored_context = json.dumps(
+                                    notifier_backends.get_context_data(
+                                        context), cls=DjangoJSONEncoder)
+                            except (TypeError, ValueError):
+                                # The failures are recorded, not retried
+                                logger.warning('Not retrying failed '
+                                    'deliveries of %s, the context cannot be '
+                                    'encoded as JSON', self.name,
+                                    exc_info=True)
+                                retry = False
+                                continue
+                        FailedDelivery.objects.add(self, backend, failed,
+                            stored_context)
+        finally:
+            dispatcher.close()
 
 
 class GroupPrefs(BaseModel):
@@ -270,6 +763,26 @@ class UserPrefs(BaseModel):
         super(UserPrefs, self).save(*args, **kwargs)
 
 
+class EffectivePrefs(models.Model):
+    """
+    Backends selected for users by the `User` and `Group` preferences, one
+    row per selected backend. Only maintained if NOTIFIER_EFFECTIVE_PREFS
+    is True.
+
+    Whether backends are enabled is not stored, it is checked when the
+    notification is sent.
+    """
+    user = models.ForeignKey(User)
+    notification = models.ForeignKey(Notification)
+    backend = models.ForeignKey(Backend)
+
+    class Meta:
+        unique_together = ('notification', 'user', 'backend')
+
+    def __unicode__(self):
+        return '%s:%s:%s' % (self.user, self.notification, self.backend)
+
+
 class SentNotification(BaseModel):
     """
     Record of every notification sent.
@@ -279,10 +792,474 @@ class SentNotification(BaseModel):
     backend = models.ForeignKey(Backend)
     success = models.BooleanField()
     read = models.BooleanField(default=False)
+    # Identifies a send, see `Notification.send`
+    idempotency_key = models.CharField(max_length=200, null=True, blank=True)
+
+    objects = managers.SentNotificationManager()
+
+    class Meta:
+        # NULL keys do not conflict
+        unique_together = ('idempotency_key', 'user', 'backend')
+        index_together = [
+            # Inbox: notifications of a user, newest first
+            ['user', 'created'],
+            # Inbox: unread notifications of a user, newest first
+            ['user', 'read', 'created'],
+            # Reports: deliveries of a notification by outcome and date
+            ['notification', 'success', 'created'],
+        ]
+
+    def __unicode__(self):
+        return '%s:%s:%s' % (self.user, self.notification, self.backend)
+
+
+class QueuedNotification(BaseModel):
+    """
+    A send waiting to be delivered by the `notifier_worker` command.
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (FAILED, 'Failed'),
+    )
+
+    notification = models.ForeignKey(Notification)
+    # JSON encoded list of user ids
+    users = models.TextField()
+    # JSON encoded context
+    context = models.TextField(blank=True)
+    # Only send with this backend, e.g. for deliveries deferred by a limit
+    backend = models.ForeignKey(Backend, null=True, blank=True)
+    # Not claimed by workers before this time
+    available = models.DateTimeField(null=True, blank=True)
+    idempotency_key = models.CharField(max_length=200, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+        default=PENDING, db_index=True)
+
+    # Set when a worker claims the send
+    worker = models.CharField(max_length=200, null=True, db_index=True)
+    locked = models.DateTimeField(null=True)
+    error = models.TextField(blank=True)
+
+    objects = managers.QueuedNotificationManager()
+
+    def __unicode__(self):
+        return '%s:%s' % (self.notification, self.status)
+
+    def get_users(self):
+        """
+        Yields the users, fetched NOTIFIER_SEND_CHUNK_SIZE at a time.
+        """
+        user_ids = json.loads(self.users)
+        chunk_size = notifier_settings.SEND_CHUNK_SIZE
+        for start in range(0, len(user_ids), chunk_size):
+            for user in User.objects.filter(
+                    pk__in=user_ids[start:start + chunk_size]).iterator():
+                yield user
+
+    def get_context(self):
+        if not self.context:
+            return {}
+        return json.loads(self.context)
+
+    def deliver(self):
+        """
+        Send the notification and remove it from the queue.
+
+        If sending raises an exception, the send is kept with status
+        `FAILED` and the exception is re-raised.
+        """
+        try:
+            backends = [self.backend] if self.backend_id else None
+            self.notification.send(self.get_users(), self.get_context(),
+                backends=backends, idempotency_key=self.idempotency_key)
+        except Exception as e:
+            self.status = self.FAILED
+            self.error = repr(e)
+            self.save()
+            raise
+        else:
+            self.delete()
+
+
+class DigestItem(BaseModel):
+    """
+    A delivery buffered until the digest window of its notification and
+    backend has passed. See NOTIFIER_DIGESTS.
+    """
+    user = models.ForeignKey(User)
+    notification = models.ForeignKey(Notification)
+    backend = models.ForeignKey(Backend)
+    # JSON encoded context of the send
+    context = models.TextField(blank=True)
+
+    class Meta:
+        index_together = [
+            ['notification', 'backend', 'user', 'created'],
+        ]
 
     def __unicode__(self):
         return '%s:%s:%s' % (self.user, self.notification, self.backend)
 
+    def get_context(self):
+        context = json.loads(self.context) if self.context else {}
+        context['created'] = self.created
+        return context
+
+
+class FailedDelivery(BaseModel):
+    """
+    A failed delivery waiting to be retried by the `notifier_retry` command,
+    or given up on after NOTIFIER_RETRY_ATTEMPTS attempts (`DEAD`).
+    """
+    PENDING = 'pending'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (DEAD, 'Dead'),
+    )
+
+    user = models.ForeignKey(User)
+    notification = models.ForeignKey(Notification)
+    backend = models.ForeignKey(Backend)
+    # JSON encoded context of the send
+    context = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=1)
+    next_attempt = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+        default=PENDING)
+
+    objects = managers.FailedDeliveryManager()
+
+    class Meta:
+        index_together = [
+            ['status', 'next_attempt'],
+        ]
+
+    def __unicode__(self):
+        return '%s:%s:%s:%s' % (self.user, self.notification, self.backend,
+            self.status)
+
+    def get_context(self):
+        if not self.context:
+            return {}
+        return json.loads(self.context)
+
+
+###############################################################################
+## Writers
+###############################################################################
+class SentNotificationWriter(object):
+    """
+    Buffers `SentNotification` records and saves them with `bulk_create`.
+
+    The buffer is flushed when `batch_size` records have been added, when the
+    oldest buffered record is older than `flush_interval` seconds and when
+    leaving the `with` block, even if an exception was raised.
+
+        with SentNotificationWriter() as writer:
+            writer.add(SentNotification(...))
+    """
+    def __init__(self, batch_size=None, flush_interval=None):
+        if batch_size is None:
+            batch_size = notifier_settings.SENT_BATCH_SIZE
+        if flush_interval is None:
+            flush_interval = notifier_settings.SENT_FLUSH_INTERVAL
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered_at = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, sentnotification):
+        if not self.buffer:
+            self.buffered_at = time()
+        self.buffer.append(sentnotification)
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        elif (self.flush_interval is not None and
+                time() - self.buffered_at >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        records, self.buffer = self.buffer, []
+        with metrics.timed('record', count=len(records)):
+            _bulk_create_new(SentNotification, records)
+
+
+def _bulk_create_new(model, objs):
+    """
+    Save `model` instances with one insert. If a concurrent request saved
+    one of them first, e.g. a send with the same idempotency key, the
+    instances are saved one at a time and the conflicting ones are skipped.
+    """
+    sid = transaction.savepoint()
+    try:
+        model.objects.bulk_create(objs)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+    else:
+        transaction.savepoint_commit(sid)
+        return
+
+    for obj in objs:
+        sid = transaction.savepoint()
+        try:
+            model.objects.bulk_create([obj])
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+
+
+###############################################################################
+## Effective Preferences
+###############################################################################
+def _iter_user_id_batches(batch_size):
+    user_ids = User.objects.order_by('pk').values_list('pk', flat=True)
+    batch = list(user_ids[:batch_size])
+    while batch:
+        yield batch
+        batch = list(user_ids.filter(pk__gt=batch[-1])[:batch_size])
+
+
+def _bitmap_ids(bitmap):
+    """
+    Returns the set of backend ids selected in a preference bitmap.
+    """
+    backend_ids = set()
+    backend_id = 0
+    while bitmap:
+        if bitmap & 1:
+            backend_ids.add(backend_id)
+        bitmap >>= 1
+        backend_id += 1
+    return backend_ids
+
+
+def _effective_prefs_rows(bitmaps):
+    return [
+        EffectivePrefs(notification_id=notification_id, user_id=user_id,
+            backend_id=backend_id)
+        for ((notification_id, user_id), bitmap) in bitmaps.items()
+        for backend_id in _bitmap_ids(bitmap)
+    ]
+
+
+def refresh_effective_prefs(notification_ids, user_ids):
+    """
+    Recompute the `EffectivePrefs` of the users for the notifications.
+    Rows inserted by an overlapping refresh of the same users are kept.
+    """
+    notification_ids = list(notification_ids)
+    user_ids = list(user_ids)
+    if not notification_ids or not user_ids:
+        return
+
+    batch_size = notifier_settings.PREFS_BATCH_SIZE
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        bitmaps = Notification._resolve_prefs_bitmaps(notification_ids,
+            batch, batch)
+        EffectivePrefs.objects.filter(notification__in=notification_ids,
+            user__in=batch).delete()
+        _bulk_create_new(EffectivePrefs, _effective_prefs_rows(bitmaps))
+
+
+@transaction.commit_on_success
+def rebuild_effective_prefs(batch_size=None):
+    """
+    Replace all `EffectivePrefs` with ones computed from the preferences,
+    `batch_size` users at a time.
+
+    Returns the number of rows created.
+    """
+    if batch_size is None:
+        batch_size = notifier_settings.PREFS_BATCH_SIZE
+    notification_ids = list(Notification.objects.values_list('pk', flat=True))
+
+    EffectivePrefs.objects.all().delete()
+    count = 0
+    for batch in _iter_user_id_batches(batch_size):
+        rows = _effective_prefs_rows(Notification._resolve_prefs_bitmaps(
+            notification_ids, batch, batch))
+        EffectivePrefs.objects.bulk_create(rows)
+        count += len(rows)
+    return count
+
+
+def check_effective_prefs(batch_size=None):
+    """
+    Compare `EffectivePrefs` to the backends resolved from the preferences.
+
+    Returns a list of ``(notification id, user id, expected backend ids,
+    stored backend ids)`` tuples for every difference.
+    """
+    if batch_size is None:
+        batch_size = notifier_settings.PREFS_BATCH_SIZE
+    notification_ids = list(Notification.objects.values_list('pk', flat=True))
+
+    differences = []
+    for batch in _iter_user_id_batches(batch_size):
+        expected = Notification._resolve_prefs_bitmaps(notification_ids,
+            batch, batch)
+        stored = dict.fromkeys(expected, 0)
+        for notification_id, user_id, backend_id in (
+                EffectivePrefs.objects.filter(user__in=batch).values_list(
+                'notification_id', 'user_id', 'backend_id')):
+            stored[(notification_id, user_id)] |= 1 << backend_id
+
+        for key in sorted(expected):
+            if expected[key] != stored[key]:
+                differences.append(key + (_bitmap_ids(expected[key]),
+                    _bitmap_ids(stored[key])))
+    return differences
+
+
+###############################################################################
+## Digests
+###############################################################################
+def send_digests():
+    """
+    Send one digest per user, notification and backend in NOTIFIER_DIGESTS
+    for which the oldest buffered `DigestItem` is older than the window.
+    The items are available to the digest templates as `digest`, a list of
+    their contexts with `created` added, oldest first.
+
+    Returns the number of digests sent.
+    """
+    sent = 0
+    shared = notifier_backends.get_context()
+
+    with SentNotificationWriter() as writer:
+        for name, windows in notifier_settings.DIGESTS.items():
+            for backend_name, window in windows.items():
+                items = DigestItem.objects.filter(notification__name=name,
+                    backend__name=backend_name)
+                due = [row['user'] for row in items.values('user').annotate(
+                    first=models.Min('created')).filter(
+                    first__lte=now() - timedelta(seconds=window))]
+                if not due:
+                    continue
+
+                notification = Notification.objects.get(name=name)
+                backend = Backend.objects.get(name=backend_name)
+                chunk_size = notifier_settings.SEND_CHUNK_SIZE
+                for start in range(0, len(due), chunk_size):
+                    user_ids = due[start:start + chunk_size]
+                    users = User.objects.in_bulk(user_ids)
+                    buffered = defaultdict(list)
+                    for item in items.filter(user__in=user_ids).order_by(
+                            'created', 'pk'):
+                        buffered[item.user_id].append(item)
+
+                    # One delivery for the chunk, e.g. over one connection
+                    if backend.enabled:
+                        contexts = dict((user_id, {'digest': [
+                            item.get_context() for item in user_items]})
+                            for (user_id, user_items) in buffered.items())
+                        backend.record(backend.deliver(
+                            [users[user_id] for user_id in buffered],
+                            notification, shared, digest=True,
+                            contexts=contexts), notification, writer)
+                        sent += len(buffered)
+                    DigestItem.objects.filter(pk__in=[item.pk
+                        for user_items in buffered.values()
+                        for item in user_items]).delete()
+
+    return sent
+
+
+###############################################################################
+## Retries
+###############################################################################
+def retry_failed_deliveries(batch_size=500):
+    """
+    Attempt up to `batch_size` failed deliveries that are due again. Every
+    attempt is recorded as a `SentNotification`. Deliveries that fail again
+    are scheduled with a longer delay, or marked `DEAD` after
+    NOTIFIER_RETRY_ATTEMPTS attempts. A delivery that raises an exception
+    fails for all its users.
+
+    Returns a ``(succeeded, failed, dead)`` tuple of counts.
+    """
+    retries = FailedDelivery.objects.due(batch_size)
+
+    # Retries of the same send are delivered together
+    groups = defaultdict(list)
+    for retry in retries:
+        groups[(retry.notification, retry.backend, retry.context)].append(
+            retry)
+
+    succeeded = []
+    failed = defaultdict(list)
+    dead = []
+    with SentNotificationWriter() as writer:
+        for (notification, backend, context), group in groups.items():
+            users = [retry.user for retry in group]
+            try:
+                results = backend.deliver(users, notification,
+                    group[0].get_context())
+            except Exception:
+                # Counted as a failed attempt, so these retries do not
+                # stay first in line and block the others
+                results = [(user, False) for user in users]
+            backend.record(results, notification, writer)
+            results = dict((user.pk, success) for (user, success) in results)
+
+            for retry in group:
+                # Users without a result were deferred to the queue
+                if results.get(retry.user_id, True):
+                    succeeded.append(retry.pk)
+                elif retry.attempts + 1 >= notifier_settings.RETRY_ATTEMPTS:
+                    dead.append(retry.pk)
+                else:
+                    failed[retry.attempts + 1].append(retry.pk)
+
+    FailedDelivery.objects.filter(pk__in=succeeded).delete()
+    FailedDelivery.objects.filter(pk__in=dead).update(
+        status=FailedDelivery.DEAD, attempts=notifier_settings.RETRY_ATTEMPTS,
+        updated=now())
+    for attempts, pks in failed.items():
+        FailedDelivery.objects.filter(pk__in=pks).update(attempts=attempts,
+            next_attempt=now() + timedelta(
+                seconds=managers.retry_delay(attempts)),
+            updated=now())
+
+    return (len(succeeded), sum(len(pks) for pks in failed.values()),
+        len(dead))
+
+
+###############################################################################
+## Metrics
+###############################################################################
+def get_queue_depths():
+    """
+    Returns the number of queued sends by status, failed deliveries waiting
+    for a retry or given up on, and buffered digest items.
+    """
+    depths = {}
+    for status, label in ((QueuedNotification.PENDING, 'queued'),
+            (QueuedNotification.PROCESSING, 'processing')):
+        depths[label] = QueuedNotification.objects.filter(
+            status=status).count()
+    for status, label in ((FailedDelivery.PENDING, 'retry'),
+            (FailedDelivery.DEAD, 'dead')):
+        depths[label] = FailedDelivery.objects.filter(status=status).count()
+    depths['digest'] = DigestItem.objects.count()
+    return depths
+
 
 ###############################################################################
 ## Signal Recievers
@@ -292,3 +1269,94 @@ class SentNotification(BaseModel):
 def backend_pre_delete(sender, instance, **kwargs):
     raise PermissionDenied(
         'Cannot delete backend %s. Remove from settings.' % instance.name)
+
+
+@receiver(post_save, sender=Backend,
+    dispatch_uid='notifier.models.backend_post_save')
+def backend_post_save(sender, instance, **kwargs):
+    _invalidate_backends(
+        instance.notification_set.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Notification.backends.through,
+    dispatch_uid='notifier.models.notification_backends_changed')
+def notification_backends_changed(sender, instance, action, reverse, pk_set,
+        **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        _invalidate_backends([instance.pk])
+    elif pk_set:
+        _invalidate_backends(pk_set)
+    else:
+        _invalidate_backends(
+            instance.notification_set.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=UserPrefs,
+    dispatch_uid='notifier.models.userprefs_post_save')
+@receiver(post_delete, sender=UserPrefs,
+    dispatch_uid='notifier.models.userprefs_post_delete')
+def userprefs_changed(sender, instance, **kwargs):
+    invalidate_prefs([instance.notification_id], [instance.user_id])
+
+
+@receiver(post_save, sender=GroupPrefs,
+    dispatch_uid='notifier.models.groupprefs_post_save')
+def groupprefs_changed(sender, instance, **kwargs):
+    invalidate_prefs([instance.notification_id],
+        User.groups.through.objects.filter(
+            group=instance.group_id).values_list('user_id', flat=True))
+
+
+@receiver(pre_delete, sender=GroupPrefs,
+    dispatch_uid='notifier.models.groupprefs_pre_delete')
+def groupprefs_pre_delete(sender, instance, **kwargs):
+    # Group memberships are gone after the group is deleted
+    instance._notifier_user_ids = list(User.groups.through.objects.filter(
+        group=instance.group_id).values_list('user_id', flat=True))
+
+
+@receiver(post_delete, sender=GroupPrefs,
+    dispatch_uid='notifier.models.groupprefs_post_delete')
+def groupprefs_post_delete(sender, instance, **kwargs):
+    invalidate_prefs([instance.notification_id],
+        getattr(instance, '_notifier_user_ids', []))
+
+
+@receiver(m2m_changed, sender=User.groups.through,
+    dispatch_uid='notifier.models.user_groups_changed')
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_clear':
+        # Collected before the memberships were removed
+        invalidate_prefs(*instance._notifier_cleared)
+        return
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        user_ids = [instance.pk]
+        if action == 'pre_clear':
+            group_ids = instance.groups.values_list('pk', flat=True)
+        else:
+            group_ids = pk_set
+    else:
+        group_ids = [instance.pk]
+        if action == 'pre_clear':
+            user_ids = instance.user_set.values_list('pk', flat=True)
+        else:
+            user_ids = pk_set
+
+    # Only notifications with preferences for these groups are affected
+    notification_ids = set(GroupPrefs.objects.filter(
+        group__in=group_ids).values_list('notification_id', flat=True))
+    if action == 'pre_clear':
+        instance._notifier_cleared = (notification_ids, list(user_ids))
+    else:
+        invalidate_prefs(notification_ids, list(user_ids))
+
+
+@receiver(post_save, sender=SentNotification,
+    dispatch_uid='notifier.models.sentnotification_post_save')
+def sentnotification_post_save(sender, instance, created, **kwargs):
+    if created:
+        SentNotification.objects.count_unread([instance])
@@ -0,0 +1,110 @@
+###############################################################################
+## Imports
+###############################################################################
+# Python
+from time import sleep, time
+
+# Django
+from django.core.cache import cache
+
+# User
+from notifier import settings as notifier_settings
+
+
+###############################################################################
+## Stats
+###############################################################################
+# Seconds spent waiting for tokens and deliveries deferred per backend name
+# in this process
+RATE_LIMIT_STATS = {}
+
+
+def get_rate_limit_stats():
+    return dict((name, dict(stats))
+        for (name, stats) in RATE_LIMIT_STATS.items())
+
+
+def reset_rate_limit_stats():
+    RATE_LIMIT_STATS.clear()
+
+
+def _record(name, throttled=0, deferred=0):
+    stats = RATE_LIMIT_STATS.setdefault(name,
+        {'throttled_seconds': 0, 'deferred': 0})
+    stats['throttled_seconds'] += throttled
+    stats['deferred'] += deferred
+
+
+###############################################################################
+## Code
+###############################################################################
+def get_bucket(name):
+    """
+    Returns the `TokenBucket` for the backend name configured in
+    NOTIFIER_RATE_LIMITS, None if the backend is not limited.
+    """
+    limit = notifier_settings.RATE_LIMITS.get(name)
+    if not limit:
+        return None
+    return TokenBucket(name, limit['rate'], limit.get('burst', limit['rate']),
+        limit.get('defer', False))
+
+
+class TokenBucket(object):
+    """
+    Token bucket holding up to `burst` tokens, refilled with `rate` tokens
+    per second. The state is kept in django's cache, so processes sharing a
+    cache that is not local memory share the limit.
+
+    Updates hold a short lock in the cache, taken with `cache.add`.
+    """
+    lock_timeout = 5
+
+    def __init__(self, name, rate, burst, defer=False):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = int(burst)
+        self.defer = defer
+        self.key = 'notifier:ratelimit:%s' % name
+        self.lock_key = self.key + ':lock'
+
+    def take(self, tokens, reserve=True):
+        """
+        Take `tokens` tokens and return 0, or return the seconds until they
+        are available. With `reserve` the tokens are taken in advance and
+        the caller has to wait the returned seconds before using them.
+        """
+        self._lock()
+        try:
+            current = time()
+            available, updated = cache.get(self.key, (self.burst, current))
+            available = min(self.burst,
+                available + (current - updated) * self.rate)
+
+            if available >= tokens:
+                wait = 0
+            else:
+                wait = (tokens - available) / self.rate
+                if not reserve:
+                    return wait
+
+            # Kept until the bucket would be full again
+            cache.set(self.key, (available - tokens, current),
+                int((self.burst - available + tokens) / self.rate) + 1)
+            return wait
+        finally:
+            cache.delete(self.lock_key)
+
+    def acquire(self, tokens):
+        """
+        Block until `tokens` tokens are taken. Returns the seconds waited.
+        """
+        wait = self.take(tokens)
+        if wait:
+            _record(self.name, throttled=wait)
+            sleep(wait)
+        return wait
+
+    def _lock(self):
+        while not cache.add(self.lock_key, 1, self.lock_timeout):
+            sleep(0.001)
@@ -19,3 +19,95 @@ BACKENDS = getattr(
 )
 
 BACKEND_CLASSES = [getattr(import_module(mod), cls) for (mod, cls) in (backend.rsplit(".", 1) for backend in BACKENDS)]
+
+# Number of SentNotification records buffered during a send before they are
+# written to the database with a single bulk insert.
+SENT_BATCH_SIZE = getattr(settings, 'NOTIFIER_SENT_BATCH_SIZE', 500)
+
+# Maximum number of seconds a SentNotification record stays buffered during a
+# send. None to only flush when the batch is full or the send is complete.
+SENT_FLUSH_INTERVAL = getattr(settings, 'NOTIFIER_SENT_FLUSH_INTERVAL', None)
+
+# If True, `send_notification` adds the send to a queue in the database
+# instead of delivering it immediately. The queue is processed by the
+# `notifier_worker` management command.
+QUEUE = getattr(settings, 'NOTIFIER_QUEUE', False)
+
+# Number of worker processes started by the `notifier_worker` command.
+WORKERS = getattr(settings, 'NOTIFIER_WORKERS', 1)
+
+# Seconds after which a queued send claimed by a worker that did not finish
+# is considered abandoned and handed to another worker.
+QUEUE_LOCK_TIMEOUT = getattr(settings, 'NOTIFIER_QUEUE_LOCK_TIMEOUT', 3600)
+
+# Seconds that resolved preferences are kept in the cache. Cached preferences
+# are invalidated when they change, so this can be long.
+PREFS_CACHE_TIMEOUT = getattr(settings, 'NOTIFIER_PREFS_CACHE_TIMEOUT',
+    60 * 60 * 24)
+
+# Number of preferences applied at a time by `update_preferences_bulk`.
+PREFS_BATCH_SIZE = getattr(settings, 'NOTIFIER_PREFS_BATCH_SIZE', 500)
+
+# Number of users handled at a time when sending a notification. Preferences
+# are resolved and SentNotification records written per chunk, so memory use
+# does not grow with the number of users.
+SEND_CHUNK_SIZE = getattr(settings, 'NOTIFIER_SEND_CHUNK_SIZE', 500)
+
+# Fields loaded for users when a notification is sent to a queryset, e.g.
+# ('email', 'first_name'). None to load all fields.
+SEND_USER_FIELDS = getattr(settings, 'NOTIFIER_SEND_USER_FIELDS', None)
+
+# Number of threads delivering notifications per backend name, e.g.
+# {'email': 4, 'sms-twilio': 8}. If set, every backend is delivered by its
+# own pool of threads (1 thread for backends not listed), so a slow backend
+# does not hold up the others. The pools are shared by all sends in the
+# process. Empty to deliver in the calling thread.
+DISPATCH_THREADS = getattr(settings, 'NOTIFIER_DISPATCH_THREADS', {})
+
+# Maximum number of deliveries in progress at the same time in this process
+# for notifications sent with `asend_notification`, the size of the pool of
+# threads delivering them.
+ASYNC_CONCURRENCY = getattr(settings, 'NOTIFIER_ASYNC_CONCURRENCY', 100)
+
+# Number of `asend_notification` sends in progress at the same time in this
+# process. Further sends wait for one of them to complete.
+ASYNC_SENDS = getattr(settings, 'NOTIFIER_ASYNC_SENDS', 10)
+
+# If True, the backends selected by the User and Group preferences are stored
+# in the EffectivePrefs table, kept up to date when preferences or group
+# memberships change. Resolving preferences then takes a single query. Run
+# the `notifier_rebuild_prefs` command after enabling it.
+EFFECTIVE_PREFS = getattr(settings, 'NOTIFIER_EFFECTIVE_PREFS', False)
+
+# Default number of days SentNotification records are kept by the
+# `notifier_prune` command. None to require --days.
+RETENTION_DAYS = getattr(settings, 'NOTIFIER_RETENTION_DAYS', None)
+
+# Seconds that the number of unread notifications of a user is kept in the
+# cache. The counters are updated when notifications are sent or marked read.
+UNREAD_CACHE_TIMEOUT = getattr(settings, 'NOTIFIER_UNREAD_CACHE_TIMEOUT',
+    60 * 60 * 24)
+
+# Digest windows in seconds per notification and backend name, e.g.
+# {'new-comment': {'email': 3600}}. Deliveries of these notifications with
+# these backends are buffered, and the `notifier_send_digests` command sends
+# every user one digest of them per window.
+DIGESTS = getattr(settings, 'NOTIFIER_DIGESTS', {})
+
+# Rate limits per backend name, e.g.
+# {'sms-twilio': {'rate': 10, 'burst': 20, 'defer': False}}. `rate` is the
+# number of messages per second, `burst` the number that can be sent at once
+# (defaults to `rate`). Sending waits for the limit, or with `defer` adds the
+# remaining users to the queue for later. Limits are shared by all processes
+# using the same cache.
+RATE_LIMITS = getattr(settings, 'NOTIFIER_RATE_LIMITS', {})
+
+# Number of times a failed delivery is attempted in total. Failed deliveries
+# are stored with their context and retried by the `notifier_retry` command.
+# 1 to not retry.
+RETRY_ATTEMPTS = getattr(settings, 'NOTIFIER_RETRY_ATTEMPTS', 1)
+
+# Seconds before the first retry. The delay doubles with every attempt, up
+# to RETRY_MAX_DELAY, and is randomly shortened by up to half.
+RETRY_DELAY = getattr(settings, 'NOTIFIER_RETRY_DELAY', 60)
+RETRY_MAX_DELAY = getattr(settings, 'NOTIFIER_RETRY_MAX_DELAY', 60 * 60 * 6)
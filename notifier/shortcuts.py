@@ -2,14 +2,20 @@
 ## Imports
 ###############################################################################
 # Python
-from collections import Iterable
+from collections import defaultdict, Iterable
 
 # Django
 from django.contrib.auth.models import Group, Permission, User
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
 from django.db.models.query import QuerySet
+from django.utils.timezone import now
 
 # User
-from notifier.models import Notification, Backend, UserPrefs
+from notifier import dispatch
+from notifier.models import (Notification, Backend, GroupPrefs, UserPrefs,
+    QueuedNotification, invalidate_prefs)
+from notifier import settings as notifier_settings
 
 
 ###############################################################################
@@ -61,20 +67,54 @@ def create_notification(name, display_name=None,
     return n
 
 
-def send_notification(name, users, context=None):
+def send_notification(name, users, context=None, queue=None,
+        idempotency_key=None):
     """
     Arguments
 
         :name: notification name (string)
         :users: user object or list of user objects
         :context: additional context for notification templates (dict)
+        :queue: add to the queue for the `notifier_worker` command instead
+            of sending now. Defaults to the NOTIFIER_QUEUE setting. (boolean)
+        :idempotency_key: identifies the send, users that already got a
+            send with the same key from a backend are skipped. (string)
 
     Returns
 
-        None
+        QueuedNotification object if queued, else None
+    """
+    notification = Notification.objects.get(name=name)
+
+    if queue is None:
+        queue = notifier_settings.QUEUE
+    if queue:
+        return QueuedNotification.objects.enqueue(notification, users, context,
+            idempotency_key=idempotency_key)
+
+    return notification.send(users, context, idempotency_key=idempotency_key)
+
+
+def asend_notification(name, users, context=None, concurrency=None):
+    """
+    Send a notification in a background thread, delivering to every user
+    and backend concurrently.
+
+    Arguments
+
+        :name: notification name (string)
+        :users: user object or list of user objects
+        :context: additional context for notification templates (dict)
+        :concurrency: number of deliveries in progress at the same time,
+            defaults to the NOTIFIER_ASYNC_CONCURRENCY setting. (int)
+
+    Returns
+
+        AsyncResult object, use its get() method to wait for the send to
+        complete
     """
     notification = Notification.objects.get(name=name)
-    return notification.send(users, context)
+    return dispatch.send_async(notification, users, context, concurrency)
 
 
 def update_preferences(name, user, prefs_dict):
@@ -101,6 +141,47 @@ def update_preferences(name, user, prefs_dict):
         return notification.update_group_prefs(user, prefs_dict)
 
 
+def update_preferences_bulk(prefs, batch_size=None):
+    """
+    Arguments
+
+        :prefs: iterable of (user or group, notification, backend, value)
+            tuples. notification and backend can be objects or names.
+
+            e.g. [(user_obj, 'card-declined', 'email', True), (group_obj, notification_obj, sms_backend_obj, False)]
+
+        :batch_size: number of tuples applied at a time, defaults to the
+            NOTIFIER_PREFS_BATCH_SIZE setting. (int)
+
+    Returns
+
+        dict with the number of preferences that were created and updated. values that do not require change are skipped
+
+        e.g. {'created': 1200, 'updated': 35}
+
+    Every batch is applied with one query to read existing preferences, one
+    bulk insert and one update per value. Raises PermissionDenied if a user
+    does not have the permissions for a notification, batches before it are
+    kept.
+    """
+    if batch_size is None:
+        batch_size = notifier_settings.PREFS_BATCH_SIZE
+
+    result = {'created': 0, 'updated': 0}
+    lookups = {'notifications': {}, 'backends': {}, 'permitted': set()}
+
+    batch = []
+    for pref in prefs:
+        batch.append(pref)
+        if len(batch) >= batch_size:
+            _update_preferences_batch(batch, result, lookups)
+            batch = []
+    if batch:
+        _update_preferences_batch(batch, result, lookups)
+
+    return result
+
+
 def clear_preferences(users):
     """
     Arguments
@@ -148,3 +229,126 @@ def _get_backend_queryset(backends):
             backends = Backend.objects.filter(name__in=backends)
 
     return backends
+
+
+def _update_preferences_batch(batch, result, lookups):
+    notifications = lookups['notifications']
+    backends = lookups['backends']
+
+    # Notifications are fetched with their permissions for check_perms
+    names = set()
+    ids = set()
+    for owner, notification, backend, value in batch:
+        if isinstance(notification, Notification):
+            if notification.pk not in notifications:
+                ids.add(notification.pk)
+        elif notification not in notifications:
+            names.add(notification)
+    if names or ids:
+        for notification in Notification.objects.filter(
+                Q(name__in=names) | Q(pk__in=ids)).prefetch_related(
+                'permissions__content_type'):
+            notifications[notification.name] = notification
+            notifications[notification.pk] = notification
+
+    names = set(backend for owner, notification, backend, value in batch
+        if not isinstance(backend, Backend) and backend not in backends)
+    if names:
+        for backend in Backend.objects.filter(name__in=names):
+            backends[backend.name] = backend
+
+    user_prefs = {}
+    group_prefs = {}
+    for owner, notification, backend, value in batch:
+        key = getattr(notification, 'pk', notification)
+        if key not in notifications:
+            raise Notification.DoesNotExist(
+                'Notification %s does not exist.' % notification)
+        notification = notifications[key]
+        if not isinstance(backend, Backend):
+            if backend not in backends:
+                raise Backend.DoesNotExist(
+                    'Backend %s does not exist.' % backend)
+            backend = backends[backend]
+
+        if isinstance(owner, User):
+            if (owner.pk, notification.pk) not in lookups['permitted']:
+                if not notification.check_perms(owner):
+                    raise PermissionDenied
+                lookups['permitted'].add((owner.pk, notification.pk))
+            user_prefs[(owner.pk, notification.pk, backend.pk)] = value
+        elif isinstance(owner, Group):
+            group_prefs[(owner.pk, notification.pk, backend.pk)] = value
+        else:
+            raise TypeError
+
+    changed = _apply_preferences(UserPrefs, 'user', user_prefs, result)
+    for notification_id, user_ids in changed.items():
+        invalidate_prefs([notification_id], user_ids)
+
+    changed = _apply_preferences(GroupPrefs, 'group', group_prefs, result)
+    if changed:
+        members = defaultdict(set)
+        for user_id, group_id in User.groups.through.objects.filter(
+                group__in=set(group_id for group_ids in changed.values()
+                    for group_id in group_ids)).values_list(
+                'user_id', 'group_id'):
+            members[group_id].add(user_id)
+        for notification_id, group_ids in changed.items():
+            invalidate_prefs([notification_id], set(user_id
+                for group_id in group_ids for user_id in members[group_id]))
+
+
+def _apply_preferences(model, owner_field, prefs, result):
+    """
+    Create and update `model` instances for `prefs`, a dict with
+    (owner id, notification id, backend id) as key and notify as value.
+
+    Returns a dict with the ids of changed owners per notification id.
+    """
+    changed = defaultdict(set)
+    if not prefs:
+        return changed
+
+    owner_id_field = owner_field + '_id'
+
+    # Read only the keys in the batch: owners per notification and backend,
+    # rather than every combination of the owners, notifications and backends
+    owners = defaultdict(set)
+    for owner_id, notification_id, backend_id in prefs:
+        owners[(notification_id, backend_id)].add(owner_id)
+    query = Q()
+    for (notification_id, backend_id), owner_ids in owners.items():
+        query |= Q(notification=notification_id, backend=backend_id,
+            **{owner_field + '__in': owner_ids})
+    existing = model.objects.filter(query).values_list('pk', owner_id_field,
+        'notification_id', 'backend_id', 'notify')
+
+    updates = defaultdict(list)
+    for pk, owner_id, notification_id, backend_id, notify in existing:
+        key = (owner_id, notification_id, backend_id)
+        if key not in prefs:
+            continue
+        value = prefs.pop(key)
+        if value != notify:
+            updates[value].append(pk)
+            changed[notification_id].add(owner_id)
+
+    for value, pks in updates.items():
+        result['updated'] += model.objects.filter(pk__in=pks).update(
+            notify=value, updated=now())
+
+    model.objects.bulk_create([
+        model(**{
+            owner_id_field: owner_id,
+            'notification_id': notification_id,
+            'backend_id': backend_id,
+            'notify': value
+        })
+        for ((owner_id, notification_id, backend_id), value) in prefs.items()
+    ])
+    result['created'] += len(prefs)
+    for owner_id, notification_id, backend_id in prefs:
+        changed[notification_id].add(owner_id)
+
+    return changed
@@ -1,21 +1,64 @@
 ###############################################################################
 ## Imports
 ###############################################################################
+# Python
+import asyncore
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import timedelta
+import gzip
+import json
+import os
+import shutil
+from smtplib import SMTPAuthenticationError, SMTPServerDisconnected
+from StringIO import StringIO
+import smtpd
+import socket
+from SocketServer import ThreadingMixIn
+import tempfile
+import threading
+import time
+import urllib2
+
 # Django
 from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
 from django.test import TestCase
 from django.contrib.auth.models import Permission
 from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.core.mail.backends import locmem
+from django.core.management.base import CommandError
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.test import TransactionTestCase
+from django.template import Context
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from django.utils.unittest import skipIf
 
 # User
-from notifier import shortcuts, models
+from notifier import (backends, dispatch, forms, metrics, ratelimit,
+    shortcuts, models)
+from notifier.management import create_backends
+from notifier import settings as notifier_settings
+from notifier.testutils import (CaptureQueries, QueryBudgetMixin,
+    query_shape)
 
 
 ###############################################################################
 ## Tests
 ###############################################################################
-class PreferencesTests(TestCase):
+class NotifierTestCase(TestCase):
+    """Clears the cache, so cached preferences don't leak between tests."""
+    def _pre_setup(self):
+        super(NotifierTestCase, self)._pre_setup()
+        cache.clear()
+
+
+class PreferencesTests(NotifierTestCase):
     def setUp(self):
         self.email_backend = models.Backend.objects.get(name='email')
 
@@ -90,7 +133,7 @@ class PreferencesTests(TestCase):
             msg='User notification preference failed.')
 
 
-class PermissionTests(TestCase):
+class PermissionTests(NotifierTestCase):
     """Tests related to permission checking for notifications."""
 
     def setUp(self):
@@ -137,7 +180,38 @@ class PermissionTests(TestCase):
             True, msg='Permission check Failed')
 
 
-class UtilityFunctionTests(TestCase):
+    def test_check_perms_queries(self):
+        self.user1.user_permissions.add(self.permission1, self.permission2)
+        self.user1 = User.objects.get(pk=self.user1.pk)
+        self.user1.get_all_permissions()
+
+        notification = models.Notification.objects.get(
+            pk=self.test1_notification.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(notification.check_perms(self.user1))
+
+        notification = models.Notification.objects.prefetch_related(
+            'permissions__content_type').get(pk=self.test1_notification.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(notification.check_perms(self.user1))
+
+
+    def test_update_without_permission(self):
+        email_backend = models.Backend.objects.get(name='email')
+        self.test1_notification.backends.add(email_backend)
+        models.UserPrefs.objects.bulk_create([models.UserPrefs(
+            user=self.user1, notification=self.test1_notification,
+            backend=email_backend, notify=True)])
+
+        self.assertRaises(PermissionDenied,
+            self.test1_notification.update_user_prefs, self.user1,
+            {'email': False})
+        self.assertRaises(PermissionDenied, shortcuts.update_preferences,
+            'test-not-1', self.user1, {'email': False})
+        self.assertTrue(models.UserPrefs.objects.get(user=self.user1).notify)
+
+
+class UtilityFunctionTests(NotifierTestCase):
     def test1GetPermissionQueryset(self):
         """Test the shortcuts._get_permission_queryset function."""
         permissions = Permission.objects.filter(id__in=[1, 2])
@@ -166,7 +240,7 @@ class UtilityFunctionTests(TestCase):
             msg='Permission codename input failed')
 
 
-class EmailTests(TestCase):
+class EmailTests(NotifierTestCase):
     def setUp(self):
         self.user1 = User.objects.create(
             username='user1',
@@ -198,3 +272,1834 @@ class EmailTests(TestCase):
 
         # Verify that the subject of the first message is correct.
         self.assertEqual(mail.outbox[0].subject, 'django-notify test email')
+
+
+class BulkResolutionTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+
+        self.sms_backend = models.Backend.objects.create(
+            display_name='SMS',
+            name='sms',
+            enabled=True,
+            description='SMS delivery method',
+            klass='notifier.backends.BaseBackend')
+
+        self.notification = models.Notification.objects.create(
+            display_name='Test Notification 1',
+            name='test-not-1',
+            public=True,
+        )
+        self.notification.backends.add(self.email_backend, self.sms_backend)
+
+        self.group1 = Group.objects.create(name='group1')
+        models.GroupPrefs.objects.create(
+            group=self.group1,
+            notification=self.notification,
+            backend=self.email_backend,
+            notify=True
+        )
+
+        self.users = []
+        for i in range(20):
+            user = User.objects.create(
+                username='user%s' % i,
+                email='user%s@example.com' % i
+            )
+            if i % 2:
+                user.groups.add(self.group1)
+            if i % 3 == 0:
+                models.UserPrefs.objects.create(
+                    user=user,
+                    notification=self.notification,
+                    backend=self.email_backend,
+                    notify=False
+                )
+            if i % 4 == 0:
+                models.UserPrefs.objects.create(
+                    user=user,
+                    notification=self.notification,
+                    backend=self.sms_backend,
+                    notify=True
+                )
+            self.users.append(user)
+
+    def test_matches_get_backends(self):
+        """Bulk resolution gives the same result as per user resolution"""
+        bulk = dict(
+            (user.pk, set(backends)) for user, backends
+            in self.notification.get_backends_bulk(self.users)
+        )
+        for user in self.users:
+            self.assertEqual(
+                bulk.get(user.pk, set()),
+                set(self.notification.get_backends(user)),
+                msg='Bulk resolution differs for %s' % user
+            )
+
+    def test_disabled_backend(self):
+        self.email_backend.enabled = False
+        self.email_backend.save()
+        for user, backends in self.notification.get_backends_bulk(self.users):
+            self.assertEqual(backends, [self.sms_backend])
+
+    def test_constant_queries(self):
+        """Number of queries does not depend on the number of users"""
+        with self.assertNumQueries(4):
+            self.notification.get_backends_bulk(self.users[:1])
+        cache.clear()
+        with self.assertNumQueries(4):
+            self.notification.get_backends_bulk(self.users)
+        cache.clear()
+        with self.assertNumQueries(5):
+            self.notification.get_backends_bulk(User.objects.all())
+
+
+class SentNotificationWriterTests(NotifierTestCase):
+    def setUp(self):
+        self.user1 = User.objects.create(
+            username='user1',
+            email='user1@example.com'
+        )
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.notification = shortcuts.create_notification('test-notification')
+
+    def _record(self):
+        return models.SentNotification(user=self.user1,
+            notification=self.notification, backend=self.email_backend,
+            success=True)
+
+    def test_batch_size(self):
+        writer = models.SentNotificationWriter(batch_size=3)
+        with self.assertNumQueries(0):
+            writer.add(self._record())
+            writer.add(self._record())
+        with self.assertNumQueries(1):
+            writer.add(self._record())
+        self.assertEqual(models.SentNotification.objects.count(), 3)
+
+    def test_flush_interval(self):
+        writer = models.SentNotificationWriter(batch_size=100,
+            flush_interval=0)
+        writer.add(self._record())
+        self.assertEqual(models.SentNotification.objects.count(), 1)
+
+    def test_flush_on_error(self):
+        try:
+            with models.SentNotificationWriter(batch_size=100) as writer:
+                writer.add(self._record())
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(models.SentNotification.objects.count(), 1)
+
+    def test_send_writes_once(self):
+        users = [self.user1]
+        for i in range(4):
+            users.append(User.objects.create(username='user-%s' % i,
+                email='user-%s@example.com' % i))
+        for user in users:
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=self.email_backend)
+
+        with self.assertNumQueries(5):
+            self.notification.send(users)
+        self.assertEqual(
+            models.SentNotification.objects.filter(success=True).count(), 5)
+
+
+class SentNotificationManagerTests(NotifierTestCase):
+    def test_unread_count(self):
+        backend = models.Backend.objects.get(name='email')
+        notification = shortcuts.create_notification('test-notification')
+        user1 = User.objects.create(username='user1')
+        user2 = User.objects.create(username='user2')
+        for user, read in ((user1, False), (user1, False), (user1, True),
+                (user2, False)):
+            models.SentNotification.objects.create(user=user,
+                notification=notification, backend=backend, success=True,
+                read=read)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                models.SentNotification.objects.unread_count(user1), 2)
+        self.assertEqual(models.SentNotification.objects.unread_count(user2), 1)
+
+    def test_unread_counter(self):
+        manager = models.SentNotification.objects
+        backend = models.Backend.objects.get(name='email')
+        notification = shortcuts.create_notification('test-notification')
+        user = User.objects.create(username='user1')
+        sent = manager.create(user=user, notification=notification,
+            backend=backend, success=True)
+
+        self.assertEqual(manager.unread_count(user), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(manager.unread_count(user), 1)
+
+        manager.bulk_create([models.SentNotification(user=user,
+            notification=notification, backend=backend, success=True)
+            for i in range(3)])
+        models.UserPrefs.objects.create(user=user, notification=notification,
+            backend=backend)
+        notification.send([user])
+        with self.assertNumQueries(0):
+            self.assertEqual(manager.unread_count(user), 5)
+
+        self.assertEqual(manager.mark_read(user, [sent.pk]), 1)
+        self.assertEqual(manager.mark_read(user, [sent.pk]), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(manager.unread_count(user), 4)
+
+        self.assertEqual(manager.mark_all_read(user), 4)
+        with self.assertNumQueries(0):
+            self.assertEqual(manager.unread_count(user), 0)
+
+        # Self-heals from the database
+        manager.filter(pk=sent.pk).update(read=False)
+        manager.invalidate_unread_counts([user.pk])
+        self.assertEqual(manager.unread_count(user), 1)
+
+    def test_unread_count_concurrent_delivery(self):
+        manager = models.SentNotification.objects
+        backend = models.Backend.objects.get(name='email')
+        notification = shortcuts.create_notification('test-notification')
+        user = User.objects.create(username='user1')
+
+        class CountThenDeliver(object):
+            """A delivery lands between the COUNT and storing the counter."""
+            def __init__(self, queryset):
+                self.queryset = queryset
+
+            def count(self):
+                count = self.queryset.count()
+                manager.bulk_create([models.SentNotification(user=user,
+                    notification=notification, backend=backend,
+                    success=True)])
+                return count
+
+        manager.filter = lambda *args, **kwargs: CountThenDeliver(
+            models.SentNotification.objects.get_query_set().filter(*args,
+                **kwargs))
+        try:
+            self.assertEqual(manager.unread_count(user), 0)
+        finally:
+            del manager.filter
+        self.assertEqual(manager.unread_count(user), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(manager.unread_count(user), 1)
+
+    def test_inbox(self):
+        manager = models.SentNotification.objects
+        backend = models.Backend.objects.get(name='email')
+        notification = shortcuts.create_notification('test-notification')
+        user = User.objects.create(username='user1')
+        other = User.objects.create(username='user2')
+        created = now()
+        sent = []
+        # Pairs with the same created, the id breaks the tie
+        for i in range(7):
+            sent.append(manager.create(user=user, notification=notification,
+                backend=backend, success=True,
+                created=created - timedelta(minutes=i // 2)))
+        manager.create(user=other, notification=notification, backend=backend,
+            success=True)
+        expected = sorted(sent, key=lambda s: (s.created, s.pk), reverse=True)
+
+        pages = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                page, cursor = manager.inbox(user, cursor, limit=3)
+            pages.append(page)
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), expected)
+
+        manager.mark_read(user, [expected[0].pk])
+        page, cursor = manager.inbox(user, unread=True)
+        self.assertEqual(page, expected[1:])
+        self.assertEqual(cursor, None)
+
+    def test_mark_read_before(self):
+        manager = models.SentNotification.objects
+        backend = models.Backend.objects.get(name='email')
+        notification = shortcuts.create_notification('test-notification')
+        user = User.objects.create(username='user1')
+        for days in (3, 2, 1, 0):
+            manager.create(user=user, notification=notification,
+                backend=backend, success=True,
+                created=now() - timedelta(days=days, hours=1))
+
+        self.assertRaises(ValueError, manager.mark_read, user)
+        with self.assertNumQueries(1):
+            self.assertEqual(manager.mark_read(user,
+                before=now() - timedelta(days=2)), 2)
+        self.assertEqual(manager.unread_count(user), 2)
+
+
+class PruneTests(NotifierTestCase):
+    def setUp(self):
+        backend = models.Backend.objects.get(name='email')
+        notification = shortcuts.create_notification('test-notification')
+        user = User.objects.create(username='user1')
+        self.old = []
+        for days in (40, 35, 31, 10, 0):
+            sent = models.SentNotification.objects.create(user=user,
+                notification=notification, backend=backend, success=True,
+                created=now() - timedelta(days=days))
+            if days > 30:
+                self.old.append(sent.pk)
+        self.export_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir)
+
+    def test_prune(self):
+        stdout = StringIO()
+        call_command('notifier_prune', days=30, batch_size=2,
+            export=self.export_dir, stdout=stdout)
+
+        self.assertEqual(models.SentNotification.objects.filter(
+            pk__in=self.old).count(), 0)
+        self.assertEqual(models.SentNotification.objects.count(), 2)
+        self.assertTrue('Deleted 2 of 3' in stdout.getvalue())
+        self.assertTrue('Deleted 3 of 3' in stdout.getvalue())
+
+        files = os.listdir(self.export_dir)
+        self.assertEqual(len(files), 1)
+        export = gzip.open(os.path.join(self.export_dir, files[0]))
+        rows = [json.loads(line) for line in export]
+        export.close()
+        self.assertEqual([row['id'] for row in rows], self.old)
+
+    def test_days_required(self):
+        self.assertRaises(CommandError, call_command, 'notifier_prune')
+
+
+class CountingEmailBackend(locmem.EmailBackend):
+    """Email backend that counts the connections opened."""
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return super(CountingEmailBackend, self).open()
+
+
+class DigestTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.notification = shortcuts.create_notification('test-notification')
+        self.users = []
+        for i in range(3):
+            user = User.objects.create(username='user%s' % i,
+                email='user%s@example.com' % i)
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=self.email_backend)
+            self.users.append(user)
+
+        self.old_digests = notifier_settings.DIGESTS
+        notifier_settings.DIGESTS = {'test-notification': {'email': 3600}}
+
+    def tearDown(self):
+        notifier_settings.DIGESTS = self.old_digests
+
+    def test_digest(self):
+        for i in range(3):
+            shortcuts.send_notification('test-notification', self.users[:2],
+                {'message': 'event %s' % i})
+        shortcuts.send_notification('test-notification', self.users[2:],
+            {'message': 'event 3'})
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(models.DigestItem.objects.count(), 7)
+
+        # Not due yet
+        self.assertEqual(models.send_digests(), 0)
+
+        models.DigestItem.objects.exclude(user=self.users[2]).update(
+            created=now() - timedelta(hours=2))
+        stdout = StringIO()
+        call_command('notifier_send_digests', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Sent 2 digests\n')
+
+        self.assertEqual(len(mail.outbox), 2)
+        for message in mail.outbox:
+            self.assertEqual(message.subject, '3 django-notify test emails')
+            self.assertEqual(message.body, 'event 0\nevent 1\nevent 2\n')
+        self.assertEqual(models.SentNotification.objects.count(), 2)
+        self.assertEqual(list(models.DigestItem.objects.values_list(
+            'user', flat=True)), [self.users[2].pk])
+
+    def test_one_connection(self):
+        for user in self.users:
+            shortcuts.send_notification('test-notification', [user],
+                Context({'message': user.username}))
+        self.assertEqual([item.get_context()['message'] for item in
+            models.DigestItem.objects.order_by('user')],
+            ['user0', 'user1', 'user2'])
+        models.DigestItem.objects.update(created=now() - timedelta(hours=2))
+
+        CountingEmailBackend.opened = 0
+        with override_settings(
+                EMAIL_BACKEND='notifier.tests.CountingEmailBackend'):
+            self.assertEqual(models.send_digests(), 3)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(sorted(message.body for message in mail.outbox),
+            ['user0\n', 'user1\n', 'user2\n'])
+
+    def test_other_backends(self):
+        notifier_settings.DIGESTS = {'test-notification': {'sms': 3600}}
+        shortcuts.send_notification('test-notification', self.users)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(models.DigestItem.objects.count(), 0)
+
+
+class RateLimitTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.notification = shortcuts.create_notification('test-notification')
+        self.users = []
+        for i in range(5):
+            user = User.objects.create(username='user%s' % i,
+                email='user%s@example.com' % i)
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=self.email_backend)
+            self.users.append(user)
+        self.old_limits = notifier_settings.RATE_LIMITS
+        ratelimit.reset_rate_limit_stats()
+
+    def tearDown(self):
+        notifier_settings.RATE_LIMITS = self.old_limits
+
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket('test', rate=10, burst=3)
+        self.assertEqual(bucket.take(3), 0)
+        self.assertAlmostEqual(bucket.take(1, reserve=False), 0.1, places=1)
+        # Reserved tokens are taken in advance
+        self.assertAlmostEqual(bucket.take(2), 0.2, places=1)
+        self.assertAlmostEqual(bucket.take(1), 0.3, places=1)
+
+    def test_blocking(self):
+        notifier_settings.RATE_LIMITS = {'email': {'rate': 50, 'burst': 2}}
+        start = time.time()
+        self.notification.send(self.users)
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(len(mail.outbox), 5)
+        stats = ratelimit.get_rate_limit_stats()['email']
+        self.assertTrue(stats['throttled_seconds'] > 0)
+        self.assertEqual(stats['deferred'], 0)
+
+    def test_defer(self):
+        notifier_settings.RATE_LIMITS = {
+            'email': {'rate': 0.01, 'burst': 2, 'defer': True}}
+        self.notification.send(self.users)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(ratelimit.get_rate_limit_stats()['email'],
+            {'throttled_seconds': 0, 'deferred': 3})
+
+        queued = models.QueuedNotification.objects.get()
+        self.assertEqual(queued.backend, self.email_backend)
+        self.assertEqual(list(queued.get_users()), self.users[2:])
+        self.assertEqual(models.QueuedNotification.objects.claim('w1'), [])
+
+        notifier_settings.RATE_LIMITS = {}
+        queued.available = now()
+        queued.save()
+        for queued in models.QueuedNotification.objects.claim('w1'):
+            queued.deliver()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(models.SentNotification.objects.count(), 5)
+
+
+class FailingBackend(backends.BaseBackend):
+    """Backend that fails for the users in FailingBackend.failing."""
+    name = 'failing'
+    failing = set()
+
+    def send(self, user, context=None):
+        super(FailingBackend, self).send(user, context)
+        if self.context.get('explode'):
+            raise RuntimeError('Delivery service error')
+        return user.username not in self.failing
+
+
+class RetryTests(NotifierTestCase):
+    def setUp(self):
+        self.backend = models.Backend.objects.create(name='failing',
+            klass='notifier.tests.FailingBackend')
+        self.notification = shortcuts.create_notification('test-notification',
+            backends=['failing'])
+        self.users = []
+        for i in range(3):
+            user = User.objects.create(username='user%s' % i)
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=self.backend)
+            self.users.append(user)
+
+        self.old_attempts = notifier_settings.RETRY_ATTEMPTS
+        notifier_settings.RETRY_ATTEMPTS = 3
+
+    def tearDown(self):
+        notifier_settings.RETRY_ATTEMPTS = self.old_attempts
+
+    def make_due(self):
+        models.FailedDelivery.objects.update(next_attempt=now())
+
+    def assertDelay(self, retry, low, high):
+        delay = (retry.next_attempt - now()).total_seconds()
+        self.assertTrue(low - 1 <= delay <= high, delay)
+
+    def test_retry(self):
+        FailingBackend.failing = set(['user0', 'user1'])
+        self.notification.send(self.users, {'amount': 10})
+
+        retries = models.FailedDelivery.objects.order_by('user')
+        self.assertEqual([retry.user for retry in retries], self.users[:2])
+        self.assertEqual(retries[0].get_context(), {'amount': 10})
+        self.assertDelay(retries[0], 30, 60)
+        self.assertEqual(models.retry_failed_deliveries(), (0, 0, 0))
+
+        self.make_due()
+        FailingBackend.failing = set(['user0'])
+        self.assertEqual(models.retry_failed_deliveries(), (1, 1, 0))
+        retry = models.FailedDelivery.objects.get()
+        self.assertEqual((retry.user, retry.attempts), (self.users[0], 2))
+        self.assertDelay(retry, 60, 120)
+
+        self.make_due()
+        self.assertEqual(models.retry_failed_deliveries(), (0, 0, 1))
+        self.assertEqual(models.FailedDelivery.objects.get().status,
+            models.FailedDelivery.DEAD)
+        self.make_due()
+        self.assertEqual(models.retry_failed_deliveries(), (0, 0, 0))
+
+        FailingBackend.failing = set()
+        stdout = StringIO()
+        call_command('notifier_retry', requeue_dead=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Requeued 1 dead deliveries\n'
+            'Succeeded 1, failed 0, dead 0\n')
+        self.assertEqual(models.FailedDelivery.objects.count(), 0)
+        self.assertEqual(models.SentNotification.objects.count(), 7)
+        self.assertEqual(
+            models.SentNotification.objects.filter(success=True).count(), 3)
+
+    def test_context_not_json(self):
+        FailingBackend.failing = set(['user0', 'user1'])
+        old_chunk_size = notifier_settings.SEND_CHUNK_SIZE
+        notifier_settings.SEND_CHUNK_SIZE = 1
+        try:
+            self.notification.send(self.users, {'order': object()})
+        finally:
+            notifier_settings.SEND_CHUNK_SIZE = old_chunk_size
+
+        self.assertEqual(models.FailedDelivery.objects.count(), 0)
+        self.assertEqual(list(models.SentNotification.objects.order_by(
+            'user').values_list('success', flat=True)), [False, False, True])
+
+    def test_exception(self):
+        FailingBackend.failing = set(['user0', 'user1'])
+        self.notification.send(self.users[:1], {'amount': 1})
+        self.notification.send(self.users[1:2], {'amount': 2})
+        models.FailedDelivery.objects.filter(user=self.users[0]).update(
+            context=json.dumps({'explode': True}))
+
+        self.make_due()
+        FailingBackend.failing = set()
+        self.assertEqual(models.retry_failed_deliveries(), (1, 1, 0))
+        retry = models.FailedDelivery.objects.get()
+        self.assertEqual((retry.user, retry.attempts), (self.users[0], 2))
+        self.assertDelay(retry, 60, 120)
+
+    def test_disabled(self):
+        notifier_settings.RETRY_ATTEMPTS = 1
+        FailingBackend.failing = set(['user0'])
+        self.notification.send(self.users)
+        self.assertEqual(models.FailedDelivery.objects.count(), 0)
+
+
+class IdempotencyTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.notification = shortcuts.create_notification('test-notification')
+        self.users = []
+        for i in range(4):
+            user = User.objects.create(username='user%s' % i,
+                email='user%s@example.com' % i)
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=self.email_backend)
+            self.users.append(user)
+
+    def test_duplicate_send(self):
+        shortcuts.send_notification('test-notification', self.users[:2],
+            idempotency_key='order-1')
+        self.assertEqual(len(mail.outbox), 2)
+
+        shortcuts.send_notification('test-notification', self.users,
+            idempotency_key='order-1')
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox[2:]),
+            ['user2@example.com', 'user3@example.com'])
+
+        self.notification.send(self.users, idempotency_key='order-1')
+        shortcuts.send_notification('test-notification', self.users[:1],
+            idempotency_key='order-2')
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(models.SentNotification.objects.filter(
+            idempotency_key='order-1').count(), 4)
+
+    def test_failed_replay(self):
+        with override_settings(
+                EMAIL_BACKEND='notifier.tests.UnreachableEmailBackend'):
+            shortcuts.send_notification('test-notification', self.users[:2],
+                idempotency_key='order-1')
+        self.assertEqual(len(mail.outbox), 0)
+
+        shortcuts.send_notification('test-notification', self.users[:2],
+            idempotency_key='order-1')
+        self.assertEqual(len(mail.outbox), 2)
+        shortcuts.send_notification('test-notification', self.users[:2],
+            idempotency_key='order-1')
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(models.SentNotification.objects.filter(
+            idempotency_key='order-1').count(), 2)
+
+    def test_single_check(self):
+        # Cache the site and the preferences
+        self.notification.send(self.users[:1])
+        self.notification.get_backends_bulk(self.users)
+        # The check and the insert of the records
+        with self.assertNumQueries(2):
+            self.notification.send(self.users, idempotency_key='order-1')
+
+    def test_deferred_duplicate(self):
+        old_limits = notifier_settings.RATE_LIMITS
+        notifier_settings.RATE_LIMITS = {
+            'email': {'rate': 0.01, 'burst': 2, 'defer': True}}
+        try:
+            for i in range(2):
+                shortcuts.send_notification('test-notification', self.users,
+                    idempotency_key='order-1')
+        finally:
+            notifier_settings.RATE_LIMITS = old_limits
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(set(models.QueuedNotification.objects.values_list(
+            'idempotency_key', flat=True)), set(['order-1']))
+
+        models.QueuedNotification.objects.update(available=now())
+        for queued in models.QueuedNotification.objects.claim('w1'):
+            queued.deliver()
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_concurrent_record(self):
+        # Recorded by another send in the meantime
+        models.SentNotification.objects.create(user=self.users[0],
+            notification=self.notification, backend=self.email_backend,
+            success=True, idempotency_key='order-1')
+
+        with models.SentNotificationWriter() as writer:
+            for user in self.users[:2]:
+                writer.add(models.SentNotification(user=user,
+                    notification=self.notification,
+                    backend=self.email_backend, success=True,
+                    idempotency_key='order-1'))
+        self.assertEqual(sorted(models.SentNotification.objects.values_list(
+            'user', flat=True)), [self.users[0].pk, self.users[1].pk])
+
+    def test_queued_duplicate(self):
+        for i in range(2):
+            shortcuts.send_notification('test-notification', self.users,
+                queue=True, idempotency_key='order-1')
+        for queued in models.QueuedNotification.objects.claim('w1'):
+            queued.deliver()
+        self.assertEqual(len(mail.outbox), 4)
+
+
+class MetricsTests(NotifierTestCase):
+    def setUp(self):
+        self.backend = models.Backend.objects.create(name='failing',
+            klass='notifier.tests.FailingBackend')
+        self.notification = shortcuts.create_notification('test-notification',
+            backends=['failing'])
+        self.users = []
+        for i in range(4):
+            user = User.objects.create(username='user%s' % i)
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=self.backend)
+            self.users.append(user)
+        FailingBackend.failing = set(['user0'])
+
+        self.sink = metrics.MemorySink()
+        self.old_sinks = metrics._sinks
+        metrics._sinks = [self.sink]
+
+    def tearDown(self):
+        metrics._sinks = self.old_sinks
+
+    def test_memory_sink(self):
+        self.notification.send(self.users)
+
+        self.assertEqual(self.sink.delivered,
+            {('test-notification', 'failing'): [3, 1]})
+        self.assertEqual(self.sink.success_rate('failing'), 0.75)
+        self.assertEqual(self.sink.success_rate('email'), None)
+        timings = self.sink.timings
+        self.assertEqual(timings[('send', 'test-notification', '')][0], 1)
+        self.assertEqual(timings[('resolve', 'test-notification', '')][0], 4)
+        self.assertEqual(
+            timings[('deliver', 'test-notification', 'failing')][0], 4)
+        self.assertEqual(timings[('record', '', '')][0], 4)
+
+    def test_signals(self):
+        phases = []
+
+        def receiver(sender, phase, **kwargs):
+            phases.append(phase)
+        metrics.phase_timed.connect(receiver)
+        try:
+            metrics._sinks = []
+            self.notification.send(self.users)
+        finally:
+            metrics.phase_timed.disconnect(receiver)
+        self.assertEqual(phases, ['resolve', 'deliver', 'record', 'send'])
+
+    def test_disabled(self):
+        metrics._sinks = []
+        with metrics.timed('send') as timer:
+            pass
+        self.assertEqual(timer.count, 1)
+        self.notification.send(self.users)
+        self.assertEqual(self.sink.timings, {})
+
+    @override_settings(ROOT_URLCONF='notifier.urls')
+    def test_prometheus_view(self):
+        self.notification.send(self.users)
+        models.QueuedNotification.objects.enqueue(self.notification,
+            self.users)
+
+        response = self.client.get('/metrics/')
+        self.assertEqual(response['Content-Type'],
+            'text/plain; version=0.0.4')
+        lines = response.content.splitlines()
+        self.assertIn('notifier_deliveries_total{backend="failing",'
+            'notification="test-notification",result="failure"} 1', lines)
+        self.assertIn('notifier_deliveries_total{backend="failing",'
+            'notification="test-notification",result="success"} 3', lines)
+        self.assertIn('notifier_phase_items_total{backend="failing",'
+            'notification="test-notification",phase="deliver"} 4', lines)
+        self.assertIn('notifier_queue_depth{queue="queued"} 1', lines)
+        self.assertIn('notifier_queue_depth{queue="dead"} 0', lines)
+
+
+class BenchmarkCommandTests(NotifierTestCase):
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command('notifier_benchmark', users=20, groups=2,
+            notifications=2, samples=3, fork=False, stdout=stdout)
+
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report['scale'], {'users': 20, 'groups': 2,
+            'notifications': 2, 'samples': 3})
+        self.assertEqual(sorted(report['results']), ['get_user_prefs',
+            'render_formset', 'send_notification', 'update_preferences',
+            'update_preferences_bulk'])
+        for result in report['results'].values():
+            self.assertTrue(result['queries'] > 0)
+            self.assertEqual(sorted(result),
+                ['peak_memory_kb', 'queries', 'seconds'])
+
+        self.assertFalse(User.objects.filter(
+            username__startswith='notifier-bench').exists())
+        self.assertFalse(models.Notification.objects.filter(
+            name__startswith='notifier-bench').exists())
+        self.assertFalse(models.Backend.objects.filter(
+            name__startswith='notifier-bench', enabled=True).exists())
+
+
+class QueryBudgetTests(QueryBudgetMixin, NotifierTestCase):
+    """
+    The public entry points run a number of queries that does not depend on
+    the number of users, notifications or records.
+    """
+    sizes = (1, 10)
+
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.sms_backend = models.Backend.objects.create(name='sms',
+            klass='notifier.backends.BaseBackend')
+        self.created = 0
+
+    def create_users(self, count):
+        users = []
+        for i in range(count):
+            self.created += 1
+            user = User.objects.create(username='user%s' % self.created,
+                email='user%s@example.com' % self.created)
+            users.append(user)
+        return users
+
+    def create_notifications(self, count, user=None):
+        notifications = []
+        for i in range(count):
+            self.created += 1
+            notification = shortcuts.create_notification(
+                'notification-%s' % self.created)
+            if user is not None:
+                models.UserPrefs.objects.create(user=user,
+                    notification=notification, backend=self.email_backend)
+            notifications.append(notification)
+        return notifications
+
+    def fresh(self, call):
+        """Run `call` with an empty cache."""
+        def wrapper():
+            cache.clear()
+            return call()
+        return wrapper
+
+    def test_query_shape(self):
+        self.assertEqual(query_shape(
+            "SELECT 'a' FROM t WHERE id IN (1, 2, 3) AND x = 'it''s'"),
+            'SELECT ? FROM t WHERE id IN (...) AND x = ?')
+        self.assertEqual(query_shape(
+            'SELECT "t"."id" FROM "t" WHERE ("t"."name" = email AND '
+            '"t"."user_id" = "u"."id" AND "t"."id" IN (SELECT 1)) LIMIT 21'),
+            'SELECT "t"."id" FROM "t" WHERE ("t"."name" = ? AND '
+            '"t"."user_id" = "u"."id" AND "t"."id" IN (SELECT ?)) LIMIT ?')
+        self.assertEqual(query_shape(
+            'INSERT INTO "t" ("a", "b") VALUES (2026-01-01 10:00:00, True)'),
+            'INSERT INTO "t" ("a", "b") VALUES (...)')
+
+    def test_report(self):
+        user = self.create_users(1)[0]
+        with self.assertRaises(AssertionError) as raised:
+            with self.assertQueryBudget(1):
+                for notification in self.create_notifications(2):
+                    notification.get_user_prefs(user)
+        self.assertIn('Duplicated query shapes:', str(raised.exception))
+
+        def setup(size):
+            notifications = self.create_notifications(size)
+            return lambda: [n.get_user_prefs(user) for n in notifications]
+        with self.assertRaises(AssertionError) as raised:
+            self.assertConstantQueries(setup, self.sizes)
+        self.assertIn('Queries depend on the size', str(raised.exception))
+
+    def test_create_notification(self):
+        def setup(size):
+            self.created += 1
+            return lambda: shortcuts.create_notification(
+                'notification-%s' % self.created, backends=['email', 'sms'])
+        self.assertConstantQueries(setup, self.sizes, budget=5)
+
+    def test_send_notification(self):
+        def setup(size):
+            notification = shortcuts.create_notification(
+                'test-notification')
+            users = self.create_users(size)
+            for user in users:
+                models.UserPrefs.objects.create(user=user,
+                    notification=notification, backend=self.email_backend)
+            Site.objects.get_current()
+            return self.fresh(lambda: shortcuts.send_notification(
+                notification.name, users))
+        self.assertConstantQueries(setup, self.sizes, budget=5)
+
+    def test_send_notification_queryset(self):
+        def setup(size):
+            notification = shortcuts.create_notification(
+                'test-notification')
+            users = self.create_users(size)
+            for user in users:
+                models.UserPrefs.objects.create(user=user,
+                    notification=notification, backend=self.email_backend)
+            Site.objects.get_current()
+            return self.fresh(lambda: shortcuts.send_notification(
+                notification.name, User.objects.filter(
+                    pk__in=[user.pk for user in users])))
+        self.assertConstantQueries(setup, self.sizes, budget=7)
+
+    def test_queue_notification(self):
+        def setup(size):
+            notification = self.create_notifications(1)[0]
+            users = self.create_users(size)
+            return lambda: shortcuts.send_notification(notification.name,
+                users, queue=True)
+        self.assertConstantQueries(setup, self.sizes, budget=2)
+
+    def test_update_preferences(self):
+        def setup(size):
+            notification = self.create_notifications(1)[0]
+            user = self.create_users(1)[0]
+            group = Group.objects.create(name='group%s' % self.created)
+            names = []
+            for i in range(size):
+                self.created += 1
+                backend = models.Backend.objects.create(
+                    name='backend%s' % self.created,
+                    klass='notifier.backends.BaseBackend')
+                notification.backends.add(backend)
+                names.append(backend.name)
+
+            def call():
+                for owner in (user, group):
+                    for value in (True, False):
+                        shortcuts.update_preferences(notification.name,
+                            owner, dict((name, value) for name in names))
+            return call
+        self.assertConstantQueries(setup, self.sizes, budget=20)
+
+    def test_update_preferences_bulk(self):
+        def setup(size):
+            notifications = self.create_notifications(size)
+            users = self.create_users(size)
+            return lambda: shortcuts.update_preferences_bulk(
+                [(user, notification, 'email', True) for user in users
+                    for notification in notifications])
+        self.assertConstantQueries(setup, self.sizes, budget=5)
+
+    def test_clear_preferences(self, budget=2):
+        def setup(size):
+            notification = self.create_notifications(1)[0]
+            users = self.create_users(size)
+            for user in users:
+                models.UserPrefs.objects.create(user=user,
+                    notification=notification, backend=self.email_backend)
+            return lambda: shortcuts.clear_preferences(users)
+        self.assertConstantQueries(setup, self.sizes, budget=budget)
+
+    def test_clear_preferences_effective(self):
+        old_effective = notifier_settings.EFFECTIVE_PREFS
+        notifier_settings.EFFECTIVE_PREFS = True
+        try:
+            self.test_clear_preferences(budget=5)
+        finally:
+            notifier_settings.EFFECTIVE_PREFS = old_effective
+
+    def test_get_user_notifications(self):
+        def setup(size):
+            user = self.create_users(1)[0]
+            self.create_notifications(size, user)
+            return self.fresh(lambda:
+                models.Notification.objects.get_user_notifications(user))
+        self.assertConstantQueries(setup, self.sizes, budget=3)
+
+    def test_get_user_prefs(self):
+        def setup(size):
+            user = self.create_users(1)[0]
+            self.create_notifications(size, user)
+            return self.fresh(lambda:
+                models.Notification.objects.get_user_prefs(user))
+        self.assertConstantQueries(setup, self.sizes, budget=5)
+
+    def test_sent_notifications(self):
+        def setup(size):
+            notification = self.create_notifications(1)[0]
+            user = self.create_users(1)[0]
+            models.SentNotification.objects.bulk_create([
+                models.SentNotification(user=user, notification=notification,
+                    backend=self.email_backend, success=True)
+                for i in range(size)])
+
+            def call():
+                cache.clear()
+                models.SentNotification.objects.unread_count(user)
+                page, cursor = models.SentNotification.objects.inbox(user)
+                models.SentNotification.objects.mark_read(user,
+                    [sent.pk for sent in page])
+                models.SentNotification.objects.mark_all_read(user)
+            return call
+        self.assertConstantQueries(setup, self.sizes, budget=4)
+
+    def test_queue(self):
+        def setup(size):
+            notification = self.create_notifications(1)[0]
+            users = self.create_users(size)
+            for user in users:
+                models.QueuedNotification.objects.enqueue(notification,
+                    [user])
+            return lambda: list(models.QueuedNotification.objects.claim('w1'))
+        self.assertConstantQueries(setup, self.sizes, budget=3)
+
+    def test_formset(self):
+        def setup(size):
+            user = self.create_users(1)[0]
+            self.create_notifications(size, user)
+            return self.fresh(lambda: unicode(forms.NotifierFormSet(user)))
+        self.assertConstantQueries(setup, self.sizes, budget=5)
+
+    def test_formset_save(self):
+        def setup(size):
+            user = self.create_users(1)[0]
+            self.create_notifications(size, user)
+            data = {
+                'form-TOTAL_FORMS': size,
+                'form-INITIAL_FORMS': size,
+            }
+            for i in range(size):
+                data['form-%s-sms' % i] = 'on'
+            formset = forms.NotifierFormSet(user, data)
+            self.assertTrue(formset.is_valid())
+            return formset.save
+        self.assertConstantQueries(setup, self.sizes, budget=5)
+
+
+class QueueTests(NotifierTestCase):
+    def setUp(self):
+        self.user1 = User.objects.create(
+            username='user1',
+            email='user1@example.com'
+        )
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.notification = shortcuts.create_notification('test-notification')
+        models.UserPrefs.objects.create(user=self.user1,
+            notification=self.notification, backend=self.email_backend)
+
+    def test_queue_and_deliver(self):
+        queued = shortcuts.send_notification('test-notification',
+            [self.user1], {'var': 1}, queue=True)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(queued.get_context(), {'var': 1})
+        self.assertEqual(list(queued.get_users()), [self.user1])
+
+        call_command('notifier_worker', once=True)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(models.QueuedNotification.objects.count(), 0)
+
+    def test_claim_once(self):
+        shortcuts.send_notification('test-notification', self.user1,
+            queue=True)
+        claimed = models.QueuedNotification.objects.claim('worker-1')
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(models.QueuedNotification.objects.claim('worker-2'),
+            [])
+
+        # Abandoned sends are claimed again after the lock timeout
+        claimed = models.QueuedNotification.objects.claim('worker-2',
+            timeout=-1)
+        self.assertEqual(len(claimed), 1)
+
+
+class PreferenceCacheTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.sms_backend = models.Backend.objects.create(
+            display_name='SMS',
+            name='sms',
+            enabled=True,
+            description='SMS delivery method',
+            klass='notifier.backends.BaseBackend')
+
+        self.notification = models.Notification.objects.create(
+            display_name='Test Notification 1',
+            name='test-not-1',
+            public=True,
+        )
+        self.notification.backends.add(self.email_backend)
+
+        self.user1 = User.objects.create(username='user1')
+        self.group1 = Group.objects.create(name='group1')
+        self.grouppref = models.GroupPrefs.objects.create(
+            group=self.group1,
+            notification=self.notification,
+            backend=self.email_backend,
+            notify=True
+        )
+
+    def assertPrefs(self, expected):
+        self.assertEqual(self.notification.get_user_prefs(self.user1),
+            expected)
+
+    def test_cached(self):
+        models.reset_prefs_cache_stats()
+        self.notification.get_user_prefs(self.user1)
+        with self.assertNumQueries(0):
+            self.notification.get_user_prefs(self.user1)
+        self.assertEqual(models.get_prefs_cache_stats(),
+            {'hits': 1, 'misses': 1})
+
+    def test_group_membership(self):
+        self.assertPrefs({self.email_backend: False})
+        self.user1.groups.add(self.group1)
+        self.assertPrefs({self.email_backend: True})
+        self.group1.user_set.clear()
+        self.assertPrefs({self.email_backend: False})
+        self.group1.user_set.add(self.user1)
+        self.assertPrefs({self.email_backend: True})
+        self.user1.groups.remove(self.group1)
+        self.assertPrefs({self.email_backend: False})
+
+    def test_group_prefs(self):
+        self.user1.groups.add(self.group1)
+        self.assertPrefs({self.email_backend: True})
+        self.grouppref.notify = False
+        self.grouppref.save()
+        self.assertPrefs({self.email_backend: False})
+        self.grouppref.notify = True
+        self.grouppref.save()
+        self.assertPrefs({self.email_backend: True})
+        self.grouppref.delete()
+        self.assertPrefs({self.email_backend: False})
+
+    def test_user_prefs(self):
+        self.user1.groups.add(self.group1)
+        self.assertPrefs({self.email_backend: True})
+        userpref = models.UserPrefs.objects.create(user=self.user1,
+            notification=self.notification, backend=self.email_backend,
+            notify=False)
+        self.assertPrefs({self.email_backend: False})
+        userpref.delete()
+        self.assertPrefs({self.email_backend: True})
+
+    def test_backends(self):
+        self.user1.groups.add(self.group1)
+        self.assertPrefs({self.email_backend: True})
+        self.notification.backends.add(self.sms_backend)
+        self.assertPrefs({self.email_backend: True, self.sms_backend: False})
+        self.email_backend.enabled = False
+        self.email_backend.save()
+        self.assertPrefs({self.sms_backend: False})
+        self.sms_backend.notification_set.clear()
+        self.assertPrefs({})
+
+
+class EffectivePrefsTests(PreferenceCacheTests):
+    """Runs the preference cache tests against the EffectivePrefs table."""
+    def setUp(self):
+        self.old_effective_prefs = notifier_settings.EFFECTIVE_PREFS
+        notifier_settings.EFFECTIVE_PREFS = True
+        super(EffectivePrefsTests, self).setUp()
+
+    def tearDown(self):
+        notifier_settings.EFFECTIVE_PREFS = self.old_effective_prefs
+
+    def assertPrefs(self, expected):
+        cache.clear()
+        self.assertEqual(models.check_effective_prefs(), [])
+        super(EffectivePrefsTests, self).assertPrefs(expected)
+
+    def test_clear_user_groups(self):
+        self.user1.groups.add(self.group1)
+        self.assertPrefs({self.email_backend: True})
+        self.user1.groups.clear()
+        self.assertPrefs({self.email_backend: False})
+
+    def test_overlapping_refresh(self):
+        self.user1.groups.add(self.group1)
+        keys = ([self.notification.pk], [self.user1.pk])
+
+        # Another refresh of the same user inserts its rows between the
+        # delete and the insert of this one
+        def refresh(sender, **kwargs):
+            post_delete.disconnect(refresh, sender=models.EffectivePrefs)
+            models.refresh_effective_prefs(*keys)
+        post_delete.connect(refresh, sender=models.EffectivePrefs)
+        try:
+            models.refresh_effective_prefs(*keys)
+        finally:
+            post_delete.disconnect(refresh, sender=models.EffectivePrefs)
+
+        self.assertEqual(models.EffectivePrefs.objects.count(), 1)
+        self.assertPrefs({self.email_backend: True})
+
+    def test_single_query(self):
+        self.user1.groups.add(self.group1)
+        cache.clear()
+        self.notification.get_enabled_backends()
+        with self.assertNumQueries(1):
+            self.notification.get_prefs_bitmaps([self.user1])
+
+    def test_rebuild(self):
+        self.user1.groups.add(self.group1)
+        models.EffectivePrefs.objects.all().delete()
+        self.assertEqual(models.check_effective_prefs(), [(
+            self.notification.pk, self.user1.pk,
+            set([self.email_backend.pk]), set())])
+        stdout = StringIO()
+        self.assertRaises(CommandError, call_command, 'notifier_rebuild_prefs',
+            check=True, stdout=stdout)
+        self.assertTrue('expected backends [%s], stored []'
+            % self.email_backend.pk in stdout.getvalue())
+
+        self.assertEqual(models.rebuild_effective_prefs(batch_size=1), 1)
+        self.assertEqual(models.check_effective_prefs(), [])
+        call_command('notifier_rebuild_prefs', check=True, stdout=StringIO())
+
+
+class FakeSMTPServer(smtpd.SMTPServer):
+    """SMTP server on a local port that keeps messages in memory."""
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(rcpttos)
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncore.loop,
+            kwargs={'timeout': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.close()
+        self.thread.join()
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """Email backend that loses its connection on the first message."""
+    failed = False
+
+    def send_messages(self, messages):
+        if not FlakyEmailBackend.failed:
+            FlakyEmailBackend.failed = True
+            raise SMTPServerDisconnected
+        return super(FlakyEmailBackend, self).send_messages(messages)
+
+
+class UnreachableEmailBackend(locmem.EmailBackend):
+    """Email backend that cannot log in to the server."""
+    def open(self):
+        raise SMTPAuthenticationError(535, 'Authentication failed')
+
+
+class DroppingEmailBackend(locmem.EmailBackend):
+    """
+    Email backend whose server drops the first connection and refuses the
+    reconnect.
+    """
+    opened = 0
+    dropped = False
+
+    def open(self):
+        DroppingEmailBackend.opened += 1
+        if DroppingEmailBackend.opened == 2:
+            raise socket.error(111, 'Connection refused')
+
+    def send_messages(self, messages):
+        if not DroppingEmailBackend.dropped:
+            DroppingEmailBackend.dropped = True
+            raise SMTPServerDisconnected('Connection unexpectedly closed')
+        return super(DroppingEmailBackend, self).send_messages(messages)
+
+
+class EmailBatchTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.notification = shortcuts.create_notification('test-notification')
+        self.users = []
+        for i in range(5):
+            user = User.objects.create(username='user%s' % i,
+                email='user%s@example.com' % i)
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=self.email_backend)
+            self.users.append(user)
+
+        self.old_chunk_size = backends.EMAIL_CHUNK_SIZE
+        backends.EMAIL_CHUNK_SIZE = 2
+
+    def tearDown(self):
+        backends.EMAIL_CHUNK_SIZE = self.old_chunk_size
+
+    def test_send_many(self):
+        shortcuts.send_notification('test-notification', self.users)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(
+            models.SentNotification.objects.filter(success=True).count(), 5)
+
+    def test_smtp_connection_reuse(self):
+        server = FakeSMTPServer()
+        server.start()
+        try:
+            with override_settings(
+                    EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                    EMAIL_HOST='127.0.0.1', EMAIL_PORT=server.port):
+                results = backends.EmailBackend(
+                    self.notification).send_many(self.users)
+        finally:
+            server.stop()
+
+        self.assertEqual(results, [(user, True) for user in self.users])
+        self.assertEqual(server.messages,
+            [[user.email] for user in self.users])
+        self.assertEqual(server.connections, 3)
+
+    def test_reconnect(self):
+        FlakyEmailBackend.failed = False
+        with override_settings(
+                EMAIL_BACKEND='notifier.tests.FlakyEmailBackend'):
+            results = backends.EmailBackend(
+                self.notification).send_many(self.users)
+
+        self.assertTrue(FlakyEmailBackend.failed)
+        self.assertEqual(results, [(user, True) for user in self.users])
+        self.assertEqual(len(mail.outbox), 5)
+
+
+    def test_connection_error(self):
+        with override_settings(
+                EMAIL_BACKEND='notifier.tests.UnreachableEmailBackend'):
+            shortcuts.send_notification('test-notification', self.users)
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(
+            models.SentNotification.objects.filter(success=False).count(), 5)
+
+    def test_reconnect_error(self):
+        DroppingEmailBackend.opened = 0
+        DroppingEmailBackend.dropped = False
+        with override_settings(
+                EMAIL_BACKEND='notifier.tests.DroppingEmailBackend'):
+            shortcuts.send_notification('test-notification', self.users)
+
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(list(models.SentNotification.objects.filter(
+            success=False).values_list('user', flat=True)), [self.users[0].pk])
+        self.assertEqual(
+            models.SentNotification.objects.filter(success=True).count(), 4)
+
+
+class TemplateCacheTests(NotifierTestCase):
+    def setUp(self):
+        backends.TEMPLATE_CACHE.clear()
+        self.template_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.template_dir, 'notifier'))
+        self.template_name = 'notifier/cache-test_email_message.txt'
+        self.write_template('first {{ user.username }}')
+
+    def tearDown(self):
+        backends.TEMPLATE_CACHE.clear()
+        shutil.rmtree(self.template_dir)
+
+    def write_template(self, content, mtime=None):
+        path = os.path.join(self.template_dir, self.template_name)
+        with open(path, 'w') as f:
+            f.write(content)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+    def test_compiled_once(self):
+        with override_settings(TEMPLATE_DIRS=[self.template_dir]):
+            template = backends.get_template(self.template_name)
+            self.write_template('second {{ user.username }}')
+            self.assertTrue(
+                backends.get_template(self.template_name) is template)
+            self.assertEqual(backends.render_to_string(self.template_name,
+                {'user': User(username='user1')}), 'first user1')
+
+    def test_debug_reload(self):
+        with override_settings(TEMPLATE_DIRS=[self.template_dir], DEBUG=True):
+            backends.get_template(self.template_name)
+            self.write_template('first {{ user.username }}', mtime=1000)
+            self.assertEqual(backends.render_to_string(self.template_name,
+                {'user': User(username='user1')}), 'first user1')
+            self.write_template('second {{ user.username }}', mtime=2000)
+            self.assertEqual(backends.render_to_string(self.template_name,
+                {'user': User(username='user1')}), 'second user1')
+
+
+class SendContextTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.notification = shortcuts.create_notification('test-notification')
+        self.users = []
+        for i in range(3):
+            user = User.objects.create(username='user%s' % i,
+                email='user%s@example.com' % i)
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=self.email_backend)
+            self.users.append(user)
+
+    def test_backend_class(self):
+        self.assertTrue(models.BACKEND_CLASSES[self.email_backend.klass] is
+            backends.EmailBackend)
+        self.assertTrue(self.email_backend.backendclass is
+            backends.EmailBackend)
+
+    def test_shared_context(self):
+        context = {'var': 1}
+        seen = []
+
+        class RecordingBackend(backends.BaseBackend):
+            name = 'recording'
+
+            def send(self, user, context=None):
+                super(RecordingBackend, self).send(user, context)
+                seen.append((self.context['user'], self.context['var'],
+                    self.context['site']))
+                return True
+
+        self.email_backend.klass = 'notifier.tests.RecordingBackend'
+        models.BACKEND_CLASSES[self.email_backend.klass] = RecordingBackend
+        try:
+            self.email_backend.send_many(self.users, self.notification,
+                context)
+        finally:
+            del models.BACKEND_CLASSES[self.email_backend.klass]
+
+        site = Site.objects.get_current()
+        self.assertEqual(seen, [(user, 1, site) for user in self.users])
+        self.assertEqual(context, {'var': 1})
+
+
+class NotificationManagerTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.sms_backend = models.Backend.objects.create(
+            display_name='SMS',
+            name='sms',
+            enabled=True,
+            description='SMS delivery method',
+            klass='notifier.backends.BaseBackend')
+
+        self.permission = Permission.objects.create(
+            codename='test-permission',
+            name='Test Permission',
+            content_type=ContentType.objects.get_for_model(User)
+        )
+
+        self.user1 = User.objects.create(username='user1')
+        self.user1.user_permissions.add(self.permission)
+        self.group1 = Group.objects.create(name='group1')
+        self.user1.groups.add(self.group1)
+
+        self.notifications = []
+        self.add_notifications(3)
+
+    def add_notifications(self, count):
+        for i in range(len(self.notifications),
+                len(self.notifications) + count):
+            notification = models.Notification.objects.create(
+                display_name='Test Notification %s' % i,
+                name='test-not-%s' % i,
+            )
+            notification.backends.add(self.email_backend, self.sms_backend)
+            notification.permissions.add(self.permission)
+            models.GroupPrefs.objects.create(group=self.group1,
+                notification=notification, backend=self.email_backend)
+            if i % 2:
+                models.UserPrefs.objects.create(user=self.user1,
+                    notification=notification, backend=self.sms_backend)
+            self.notifications.append(notification)
+
+        # Permission without the user permission, not listed
+        restricted = models.Notification.objects.create(
+            display_name='Restricted %s' % i,
+            name='restricted-%s' % i,
+        )
+        restricted.permissions.add(Permission.objects.exclude(
+            pk=self.permission.pk)[0])
+
+    def get_user(self):
+        # Permissions are cached on the user object
+        return User.objects.get(pk=self.user1.pk)
+
+    def test_get_user_prefs(self):
+        prefs = models.Notification.objects.get_user_prefs(self.get_user())
+        self.assertEqual(prefs, dict(
+            (notification, notification.get_user_prefs(self.user1))
+            for notification in self.notifications
+        ))
+
+    def assertQueries(self, num, func):
+        cache.clear()
+        user = self.get_user()
+        with self.assertNumQueries(num):
+            return func(user)
+
+    def test_constant_queries(self):
+        manager = models.Notification.objects
+        self.assertQueries(9, manager.get_user_prefs)
+        self.assertQueries(6, manager.get_user_notifications)
+        self.assertEqual(len(self.assertQueries(9, forms.NotifierFormSet)), 3)
+
+        self.add_notifications(10)
+        self.assertEqual(len(self.assertQueries(9, manager.get_user_prefs)), 13)
+        self.assertEqual(
+            len(self.assertQueries(6, manager.get_user_notifications)), 13)
+        self.assertEqual(len(self.assertQueries(9, forms.NotifierFormSet)), 13)
+
+
+class BulkPreferencesTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.sms_backend = models.Backend.objects.create(
+            display_name='SMS',
+            name='sms',
+            enabled=True,
+            description='SMS delivery method',
+            klass='notifier.backends.BaseBackend')
+        self.notification = shortcuts.create_notification('test-notification',
+            backends=['email', 'sms'])
+        self.group1 = Group.objects.create(name='group1')
+        self.users = [User.objects.create(username='user%s' % i)
+            for i in range(10)]
+
+    def test_create_and_update(self):
+        prefs = [(user, 'test-notification', 'email', True)
+            for user in self.users]
+        prefs.append((self.group1, self.notification, self.sms_backend, True))
+        self.assertEqual(shortcuts.update_preferences_bulk(prefs),
+            {'created': 11, 'updated': 0})
+
+        prefs = [(user, 'test-notification', 'email', bool(i % 2))
+            for (i, user) in enumerate(self.users)]
+        self.assertEqual(
+            shortcuts.update_preferences_bulk(prefs, batch_size=3),
+            {'created': 0, 'updated': 5})
+
+        for i, user in enumerate(self.users):
+            self.assertEqual(self.notification.get_user_prefs(user),
+                {self.email_backend: bool(i % 2), self.sms_backend: False})
+
+        self.users[0].groups.add(self.group1)
+        shortcuts.update_preferences_bulk(
+            [(self.group1, 'test-notification', 'sms', False)])
+        self.assertEqual(self.notification.get_user_prefs(self.users[0]),
+            {self.email_backend: False, self.sms_backend: False})
+
+    def test_constant_queries(self):
+        prefs = [(user, self.notification, backend, True)
+            for user in self.users
+            for backend in (self.email_backend, self.sms_backend)]
+        with self.assertNumQueries(4):
+            shortcuts.update_preferences_bulk(prefs[:2])
+        prefs = [(user, self.notification, backend, False)
+            for user in self.users
+            for backend in (self.email_backend, self.sms_backend)]
+        with self.assertNumQueries(5):
+            shortcuts.update_preferences_bulk(prefs)
+
+    def test_permissions(self):
+        permission = Permission.objects.create(
+            codename='test-permission',
+            name='Test Permission',
+            content_type=ContentType.objects.get_for_model(User)
+        )
+        self.notification.permissions.add(permission)
+        self.assertRaises(PermissionDenied, shortcuts.update_preferences_bulk,
+            [(self.users[0], 'test-notification', 'email', True)])
+        self.assertEqual(models.UserPrefs.objects.count(), 0)
+
+    def test_reads_batch_keys(self):
+        shortcuts.update_preferences_bulk([(user, self.notification, backend,
+            True) for user in self.users
+            for backend in (self.email_backend, self.sms_backend)])
+
+        # The existing sms preference of users[0] and email preference of
+        # users[1] are not in the batch and not read
+        with CaptureQueries() as captured:
+            shortcuts.update_preferences_bulk([
+                (self.users[0], self.notification, self.email_backend, False),
+                (self.users[1], self.notification, self.sms_backend, False)])
+        read = [sql for sql in captured.queries
+            if sql.startswith('SELECT') and 'FROM "notifier_userprefs"' in sql]
+        self.assertEqual(len(read), 1)
+        for user, backend in ((self.users[0], self.email_backend),
+                (self.users[1], self.sms_backend)):
+            self.assertEqual(models.UserPrefs.objects.get(user=user,
+                backend=backend).notify, False)
+        self.assertEqual(models.UserPrefs.objects.filter(notify=True).count(),
+            18)
+        self.assertEqual(
+            read[0].count('"notifier_userprefs"."backend_id" ='), 2)
+
+    def test_does_not_exist(self):
+        self.assertRaises(models.Notification.DoesNotExist,
+            shortcuts.update_preferences_bulk,
+            [(self.users[0], 'unknown-notification', 'email', True)])
+        self.assertRaises(models.Backend.DoesNotExist,
+            shortcuts.update_preferences_bulk,
+            [(self.users[0], 'test-notification', 'unknown-backend', True)])
+        self.assertEqual(models.UserPrefs.objects.count(), 0)
+
+
+class ChunkedSendTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.notification = shortcuts.create_notification('test-notification')
+        self.group1 = Group.objects.create(name='group1')
+        models.GroupPrefs.objects.create(group=self.group1,
+            notification=self.notification, backend=self.email_backend)
+        for i in range(7):
+            user = User.objects.create(username='user%s' % i,
+                email='user%s@example.com' % i)
+            user.groups.add(self.group1)
+
+        self.old_chunk_size = notifier_settings.SEND_CHUNK_SIZE
+        notifier_settings.SEND_CHUNK_SIZE = 3
+
+    def tearDown(self):
+        notifier_settings.SEND_CHUNK_SIZE = self.old_chunk_size
+
+    def test_chunks(self):
+        users = User.objects.all()
+        chunks = list(models._iter_user_chunks(users, 3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertEqual(sum(chunks, []), list(users.order_by('pk')))
+
+        chunks = list(models._iter_user_chunks(iter(users), 3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+
+    def test_send_queryset(self):
+        self.notification.send(User.objects.all())
+        self.assertEqual(len(mail.outbox), 7)
+        self.assertEqual(models.SentNotification.objects.count(), 7)
+
+    def test_send_sliced_queryset(self):
+        shortcuts.send_notification('test-notification',
+            User.objects.order_by('-pk')[:5])
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+            ['user%s@example.com' % i for i in range(2, 7)])
+
+    def test_user_fields(self):
+        old_fields = notifier_settings.SEND_USER_FIELDS
+        notifier_settings.SEND_USER_FIELDS = ('email', 'username')
+        try:
+            chunk = next(models._iter_user_chunks(User.objects.all(), 3))
+            self.assertTrue(chunk[0]._deferred)
+            self.notification.send(User.objects.all())
+        finally:
+            notifier_settings.SEND_USER_FIELDS = old_fields
+        self.assertEqual(len(mail.outbox), 7)
+
+    def test_send_many_per_chunk(self):
+        batch_backend = models.Backend.objects.create(name='batch',
+            klass='notifier.tests.BatchRecordingBackend')
+        self.notification.backends.add(batch_backend)
+        models.GroupPrefs.objects.create(group=self.group1,
+            notification=self.notification, backend=batch_backend)
+        BatchRecordingBackend.batches = []
+
+        self.notification.send(User.objects.all())
+        self.assertEqual(BatchRecordingBackend.batches, [3, 3, 1])
+        self.assertEqual(len(mail.outbox), 7)
+        self.assertEqual(models.SentNotification.objects.filter(
+            backend=batch_backend, success=True).count(), 7)
+
+    def test_default_send_many(self):
+        users = list(User.objects.all())
+        results = ThreadRecordingBackend(self.notification).send_many(users,
+            {'foo': 'bar'})
+        self.assertEqual(results, [(user, True) for user in users])
+
+
+class BatchRecordingBackend(backends.BaseBackend):
+    """Backend that records the number of users of every batch."""
+    name = 'batch'
+    batches = []
+
+    def send_many(self, users, context=None):
+        self.batches.append(len(users))
+        return [(user, True) for user in users]
+
+
+class ThreadRecordingBackend(backends.BaseBackend):
+    """Backend that records the thread used for every user."""
+    name = 'thread-recording'
+    threads = []
+
+    def send(self, user, context=None):
+        super(ThreadRecordingBackend, self).send(user, context)
+        self.threads.append((self.notification.name, user,
+            threading.current_thread().name))
+        return True
+
+
+class DispatchTests(NotifierTestCase):
+    def setUp(self):
+        self.email_backend = models.Backend.objects.get(name='email')
+        self.notification = shortcuts.create_notification('test-notification')
+        self.users = []
+        for i in range(6):
+            user = User.objects.create(username='user%s' % i,
+                email='user%s@example.com' % i)
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=self.email_backend)
+            self.users.append(user)
+        ThreadRecordingBackend.threads = []
+
+    def test_threaded_dispatcher(self):
+        backend1 = models.Backend(pk=1001, name='recording-1',
+            klass='notifier.tests.ThreadRecordingBackend')
+        backend2 = models.Backend(pk=1002, name='recording-2',
+            klass='notifier.tests.ThreadRecordingBackend')
+
+        dispatcher = dispatch.ThreadedDispatcher({'recording-1': 3})
+        try:
+            results = dispatcher.deliver(
+                {backend1: self.users, backend2: self.users},
+                self.notification, {})
+            self.assertEqual(len(dispatcher.pools['recording-1']._pool), 3)
+            self.assertEqual(len(dispatcher.pools['recording-2']._pool), 1)
+            pool = dispatcher.pools['recording-1']
+        finally:
+            dispatcher.close()
+
+        # Later sends use the same threads
+        dispatcher = dispatch.ThreadedDispatcher({'recording-1': 3})
+        self.assertIs(dispatcher.get_pool(backend1), pool)
+
+        self.assertEqual(
+            sorted((backend.pk, user.pk, success)
+                for (backend, result) in results
+                for (user, success) in result),
+            sorted((backend.pk, user.pk, True)
+                for backend in (backend1, backend2) for user in self.users))
+
+        threads = set(thread for (name, user, thread)
+            in ThreadRecordingBackend.threads)
+        self.assertFalse(threading.current_thread().name in threads)
+
+    def test_threaded_send(self):
+        old_threads = notifier_settings.DISPATCH_THREADS
+        notifier_settings.DISPATCH_THREADS = {'email': 2}
+        try:
+            shortcuts.send_notification('test-notification', self.users)
+        finally:
+            notifier_settings.DISPATCH_THREADS = old_threads
+
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(
+            models.SentNotification.objects.filter(success=True).count(), 6)
+
+
+class StubHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server on a local port that keeps request bodies in memory and
+    records the most requests handled at the same time.
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0.05):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHTTPHandler)
+        self.url = 'http://127.0.0.1:%s/' % self.server_address[1]
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.bodies = []
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+            kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class StubHTTPHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+            server.bodies.append(body)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPBackend(backends.BaseBackend):
+    """Backend that posts the username to HTTPBackend.url."""
+    name = 'http'
+    url = None
+
+    def send(self, user, context=None):
+        super(HTTPBackend, self).send(user, context)
+        urllib2.urlopen(self.url, user.username).read()
+        return True
+
+
+class ConcurrentDispatchTests(NotifierTestCase):
+    def setUp(self):
+        self.server = StubHTTPServer()
+        self.server.start()
+        HTTPBackend.url = self.server.url
+        self.notification = shortcuts.create_notification('test-notification')
+        self.users = [User(pk=i, username='user%s' % i) for i in range(1, 13)]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_concurrency_cap(self):
+        backend = models.Backend(pk=1001, name='http',
+            klass='notifier.tests.HTTPBackend')
+
+        dispatcher = dispatch.ConcurrentDispatcher(4)
+        try:
+            results = dispatcher.deliver({backend: self.users},
+                self.notification, {})
+        finally:
+            dispatcher.close()
+
+        self.assertEqual(
+            sorted(user.pk for (backend, result) in results
+                for (user, success) in result if success),
+            [user.pk for user in self.users])
+        self.assertEqual(sorted(self.server.bodies),
+            sorted(user.username for user in self.users))
+        self.assertEqual(self.server.max_active, 4)
+
+    def test_shared_pool(self):
+        dispatcher1 = dispatch.ConcurrentDispatcher(4)
+        dispatcher2 = dispatch.ConcurrentDispatcher(2)
+        self.assertIs(dispatcher1.pool, dispatcher2.pool)
+        self.assertEqual(len(dispatcher1.pool._pool),
+            notifier_settings.ASYNC_CONCURRENCY)
+
+
+@skipIf(connection.vendor == 'sqlite' and
+    not connection.settings_dict.get('TEST_NAME'),
+    'in-memory sqlite databases are not shared between threads')
+class AsyncSendTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.server = StubHTTPServer()
+        self.server.start()
+        HTTPBackend.url = self.server.url
+        backend = models.Backend.objects.create(name='http',
+            klass='notifier.tests.HTTPBackend')
+        self.notification = shortcuts.create_notification('test-notification',
+            backends=['http'])
+        self.users = []
+        for i in range(8):
+            user = User.objects.create(username='user%s' % i)
+            models.UserPrefs.objects.create(user=user,
+                notification=self.notification, backend=backend)
+            self.users.append(user)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _fixture_teardown(self):
+        super(AsyncSendTests, self)._fixture_teardown()
+        # Restore the backends removed by the flush for the next tests
+        create_backends('notifier')
+
+    def test_asend_notification(self):
+        result = shortcuts.asend_notification('test-notification', self.users,
+            concurrency=3)
+        result.get(timeout=10)
+
+        self.assertEqual(sorted(self.server.bodies),
+            sorted(user.username for user in self.users))
+        self.assertEqual(self.server.max_active, 3)
+        self.assertEqual(
+            models.SentNotification.objects.filter(success=True).count(), 8)
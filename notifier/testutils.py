@@ -0,0 +1,154 @@
+"""
+Helpers to keep the number of queries of the notifier entry points in check.
+
+    from notifier.testutils import QueryBudgetMixin
+
+    class MyTests(QueryBudgetMixin, TestCase):
+        def test_inbox(self):
+            with self.assertQueryBudget(2):
+                SentNotification.objects.inbox(self.user)
+
+`query_budget` is the same check as a context manager for other test
+runners, e.g. pytest.
+"""
+###############################################################################
+## Imports
+###############################################################################
+# Python
+from collections import Counter
+import re
+
+# Django
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+###############################################################################
+## Query Shapes
+###############################################################################
+_STRING = re.compile(r"'(?:[^']|'')*'")
+# SQLite logs parameters without quotes
+_COMPARED = re.compile(r'(=|<>|!=|<=|>=|<|>|\bLIKE) (?![("])[^\s,()]+',
+    re.IGNORECASE)
+_IN_LIST = re.compile(r'\bIN \((?!SELECT\b)[^()]*\)', re.IGNORECASE)
+_VALUES = re.compile(r'\bVALUES \(.*\)', re.IGNORECASE)
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def query_shape(sql):
+    """
+    Returns `sql` with literal values replaced by ``?`` and ``IN`` and
+    ``VALUES`` lists of any length collapsed, so queries differing only in
+    values are equal.
+    """
+    shape = _STRING.sub('?', sql)
+    shape = _COMPARED.sub(r'\1 ?', shape)
+    shape = _IN_LIST.sub('IN (...)', shape)
+    shape = _VALUES.sub('VALUES (...)', shape)
+    shape = _NUMBER.sub('?', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+class CaptureQueries(object):
+    """
+    Records the SQL of the queries run on a connection in the `with` block.
+
+        with CaptureQueries() as captured:
+            ...
+        captured.count, captured.duplicates()
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.queries = []
+
+    def __enter__(self):
+        self.old_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.start = len(self.connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.use_debug_cursor = self.old_debug_cursor
+        self.queries = [query['sql']
+            for query in self.connection.queries[self.start:]]
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def duplicates(self):
+        """
+        Returns ``(shape, count)`` tuples for the query shapes run more than
+        once, most frequent first. These are usually N+1 queries.
+        """
+        return [(shape, count) for (shape, count)
+            in Counter(query_shape(sql) for sql in self.queries).most_common()
+            if count > 1]
+
+    def report(self):
+        lines = ['%s queries' % self.count]
+        duplicates = self.duplicates()
+        if duplicates:
+            lines.append('Duplicated query shapes:')
+            lines.extend('%5d x %s' % (count, shape)
+                for (shape, count) in duplicates)
+        lines.append('Queries:')
+        lines.extend('%5d. %s' % (i, sql)
+            for (i, sql) in enumerate(self.queries, 1))
+        return '\n'.join(lines)
+
+
+###############################################################################
+## Budgets
+###############################################################################
+class query_budget(CaptureQueries):
+    """
+    Raises AssertionError with a report of the queries if more than
+    `budget` queries are run in the `with` block.
+    """
+    def __init__(self, budget, using=DEFAULT_DB_ALIAS):
+        super(query_budget, self).__init__(using)
+        self.budget = budget
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(query_budget, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is None and self.count > self.budget:
+            raise AssertionError('Query budget of %s exceeded: %s' % (
+                self.budget, self.report()))
+
+
+class QueryBudgetMixin(object):
+    """
+    `TestCase` mixin with assertions on the number of queries.
+    """
+    def assertQueryBudget(self, budget, using=DEFAULT_DB_ALIAS):
+        """
+        Context manager failing if more than `budget` queries are run in
+        the `with` block.
+        """
+        return query_budget(budget, using)
+
+    def assertConstantQueries(self, setup, sizes, budget=None,
+            using=DEFAULT_DB_ALIAS):
+        """
+        Fail unless the call returned by `setup(size)` runs the same number
+        of queries for every size in `sizes`, and no more than `budget`.
+        `setup` creates `size` objects, e.g. users or notifications, and
+        returns the call under test.
+        """
+        captures = []
+        for size in sizes:
+            call = setup(size)
+            with CaptureQueries(using) as captured:
+                call()
+            captures.append((size, captured))
+
+        counts = [captured.count for (size, captured) in captures]
+        if len(set(counts)) > 1:
+            self.fail('Queries depend on the size (%s):\n%s' % (
+                ', '.join('%s queries for %s' % (captured.count, size)
+                    for (size, captured) in captures),
+                captures[-1][1].report()))
+        if budget is not None and counts[0] > budget:
+            self.fail('Query budget of %s exceeded: %s' % (budget,
+                captures[0][1].report()))
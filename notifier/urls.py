@@ -0,0 +1,13 @@
+###############################################################################
+## Imports
+###############################################################################
+# Django
+from django.conf.urls import patterns, url
+
+
+###############################################################################
+## URLs
+###############################################################################
+urlpatterns = patterns('notifier.views',
+    url(r'^metrics/$', 'prometheus_metrics', name='notifier_metrics'),
+)
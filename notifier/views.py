@@ -0,0 +1,23 @@
+###############################################################################
+## Imports
+###############################################################################
+# Django
+from django.http import HttpResponse
+
+# User
+from notifier import metrics
+from notifier.models import get_queue_depths
+
+
+###############################################################################
+## Code
+###############################################################################
+def prometheus_metrics(request):
+    """
+    Metrics of this process from the `MemorySink`, if it is configured in
+    NOTIFIER_METRIC_SINKS, and the current queue depths in the Prometheus
+    text format.
+    """
+    content = metrics.render_prometheus(
+        metrics.get_sink(metrics.MemorySink), get_queue_depths())
+    return HttpResponse(content, content_type='text/plain; version=0.0.4')
@@ -25,6 +25,6 @@ setup(
         'Topic :: Software Development :: Libraries :: Python Modules'
     ],
     install_requires=[
-        "Django >= 1.4.0",
+        "Django >= 1.5.0",
     ],
 )